@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import AsyncIterator
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import backend  # noqa: E402
+
+import sessions  # noqa: E402
+import utils as ut  # noqa: E402
+
+
+def duration(voice: Path) -> float:
+    out = subprocess.check_output(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=duration",
+            "-of",
+            "csv=p=0",
+            str(voice),
+        ]
+    )
+    return float(out.decode().strip())
+
+
+async def chunks(data: bytes) -> AsyncIterator[bytes]:
+    for idx in range(0, len(data), backend.CHUNK_SIZE):
+        yield data[idx : idx + backend.CHUNK_SIZE]
+
+
+async def transcribe(name: str, data: bytes, dur: float) -> str:
+    if name == "whisper":
+        return await backend.asr_whisper("", chunks(data))
+    elif name == "assemblyai":
+        return await backend.asr_assemblyai(chunks(data), dur)
+    return await backend.asr_local(chunks(data))
+
+
+async def run(backends: list, voices: list) -> None:
+    samples = [(vc, vc.read_bytes(), duration(vc)) for vc in voices]
+    for name in backends:
+        if name == "local":
+            start = time.perf_counter()
+            await transcribe(name, samples[0][1], samples[0][2])
+            print(
+                f"local: cold start (model load + first note) "
+                f"{time.perf_counter() - start:.2f}s"
+            )
+        latency = []
+        rtf = []
+        for vc, data, dur in samples:
+            start = time.perf_counter()
+            text = await transcribe(name, data, dur)
+            elapsed = time.perf_counter() - start
+            latency.append(elapsed)
+            rtf.append(elapsed / dur)
+            print(
+                f"{name}: {vc.name} ({dur:.1f}s) -> {elapsed:.2f}s, "
+                f"RTF {elapsed / dur:.3f}: {text}"
+            )
+        print(
+            f"{name}: latency mean {statistics.mean(latency):.2f}s, "
+            f"max {max(latency):.2f}s, "
+            f"RTF mean {statistics.mean(rtf):.3f}\n"
+        )
+    backend.shutdown_asr()
+    await sessions.close()
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="asr-benchmark",
+        description=(
+            "Compare real-time factor and end-to-end latency of "
+            "ASR backends on sample voice notes"
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        default="config/config.json",
+        help="Configuration file path. Default: config/config.json",
+    )
+    parser.add_argument(
+        "-b",
+        "--backends",
+        nargs="+",
+        default=["local"],
+        choices=["whisper", "assemblyai", "local"],
+        help="Backends to benchmark. Default: local",
+    )
+    parser.add_argument(
+        "voices", nargs="+", type=Path, help="Voice notes (.oga) to transcribe"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    with open(args.config) as f:
+        ut.DATA["config"] = json.load(f)
+    ut.set_defaults(ut.DATA["config"])
+    asyncio.run(run(args.backends, args.voices))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+from uuid import uuid4
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import backend  # noqa: E402
+
+import sessions  # noqa: E402
+import utils as ut  # noqa: E402
+
+# Mock voice notes carry BYTES_PER_SECOND bytes per second of audio
+BYTES_PER_SECOND = 2000
+PROCESSING_RATIO = 0.15
+PROCESSING_MIN = 0.3
+TRANSCRIPTS = {}
+STATS = {"polls": 0}
+
+
+async def upload(request: web.Request) -> web.Response:
+    data = await request.read()
+    upload_id = str(uuid4())
+    TRANSCRIPTS[upload_id] = len(data) / BYTES_PER_SECOND
+    return web.json_response(
+        {"upload_url": f"http://mock/{upload_id}"}  # only the id is used
+    )
+
+
+async def transcript(request: web.Request) -> web.Response:
+    body = await request.json()
+    upload_id = body["audio_url"].split("/")[-1]
+    duration = TRANSCRIPTS.pop(upload_id)
+    transcript_id = str(uuid4())
+    TRANSCRIPTS[transcript_id] = time.monotonic() + max(
+        PROCESSING_MIN, duration * PROCESSING_RATIO
+    )
+    return web.json_response({"id": transcript_id, "status": "queued"})
+
+
+async def status(request: web.Request) -> web.Response:
+    STATS["polls"] += 1
+    transcript_id = request.match_info["tid"]
+    if time.monotonic() < TRANSCRIPTS[transcript_id]:
+        return web.json_response({"status": "processing"})
+    return web.json_response({"status": "completed", "text": "mock"})
+
+
+async def run(durations: list, port: int, fixed: bool) -> None:
+    app = web.Application(client_max_size=0)
+    app.add_routes(
+        [
+            web.post("/upload", upload),
+            web.post("/transcript", transcript),
+            web.get("/transcript/{tid}", status),
+        ]
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    backend.ASR_API = f"http://127.0.0.1:{port}"
+    if fixed:
+        backend.ASR_POLL_MIN = backend.ASR_POLL_MAX = 5
+    for duration in durations:
+        data = bytearray(int(duration * BYTES_PER_SECOND))
+        STATS["polls"] = 0
+        latency = []
+        for _ in range(3):
+            start = time.perf_counter()
+            await backend.asr_assemblyai(data, duration)
+            latency.append(time.perf_counter() - start)
+        print(
+            f"{duration:>5}s clip: latency mean "
+            f"{statistics.mean(latency):.2f}s, polls {STATS['polls'] / 3:.1f}"
+        )
+    await sessions.close()
+    await runner.cleanup()
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="assemblyai-benchmark",
+        description=(
+            "Measure AssemblyAI backend latency against a local mock server"
+        ),
+    )
+    parser.add_argument(
+        "-d",
+        "--durations",
+        nargs="+",
+        type=int,
+        default=[2, 10, 30, 120],
+        help="Voice note durations in seconds. Default: 2 10 30 120",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=8089,
+        help="Mock server port. Default: 8089",
+    )
+    parser.add_argument(
+        "--fixed",
+        action="store_true",
+        help="Poll every 5 seconds, as the previous implementation did",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    ut.DATA["config"] = {"apis": {"assemblyai": "mock"}}
+    asyncio.run(run(args.durations, args.port, args.fixed))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import random
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import database as db  # noqa: E402
+
+import utils as ut  # noqa: E402
+
+
+def legacy(cid: int) -> bool:
+    # Checks done by every handler before the authorization cache
+    if cid in ut.chats("id") and not db.cached(cid):
+        db.add_user(cid)
+    return bool(db.cached(cid))
+
+
+def cached(cid: int) -> bool:
+    ut.add_whitelisted(cid)
+    return ut.unlocked(cid)
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="auth-benchmark",
+        description="Measure permission checks with a large allow list",
+    )
+    parser.add_argument(
+        "-s",
+        "--size",
+        type=int,
+        default=50000,
+        help="Allowed chat ids. Default: 50000",
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=2000,
+        help="Permission checks. Default: 2000",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    with tempfile.TemporaryDirectory() as tmp:
+        ut.PATH.update(dir=tmp, database="edge.db")
+        db.setup_db()
+        allowed = list(range(10**9, 10**9 + args.size))
+        ut.DATA["config"] = {"chats": {"id": allowed, "admin": allowed[:1]}}
+        ut.load_auth()
+        cids = random.choices(allowed, k=args.number)
+        for cid in set(cids):  # unlock on first contact is not measured
+            ut.add_whitelisted(cid)
+        for name, func in (("legacy", legacy), ("cached", cached)):
+            elapsed = timeit.timeit(
+                lambda: [func(cid) for cid in cids], number=1
+            )
+            print(
+                f"{name}: {elapsed / args.number * 1e6:.1f} µs per check "
+                f"({args.size} allowed ids)"
+            )
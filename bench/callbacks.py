@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import edge  # noqa: E402
+
+# Every callback_data generated by the bot and its expected route
+MATRIX = [
+    ("conv_new", edge.conv_new, []),
+    ("conv_set_a1b2c3d4e5", edge.conv_set, ["a1b2c3d4e5"]),
+    ("conv_delete_a1b2c3d4e5", edge.conv_delete, ["a1b2c3d4e5"]),
+    ("conv_delete_bt_a1b2c3d4e5", edge.conv_delete, ["bt_a1b2c3d4e5"]),
+    ("conv_export_a1b2c3d4e5", edge.conv_export, ["a1b2c3d4e5"]),
+    ("conv_export_bt_a1b2c3d4e5", edge.conv_export, ["bt_a1b2c3d4e5"]),
+    ("settings_menu", edge.settings_menu, []),
+    ("langs_menu", edge.langs_menu, []),
+    ("genders_menu_en", edge.genders_menu, ["en"]),
+    ("voices_menu_en_Female", edge.voices_menu, ["en", "Female"]),
+    (
+        "voice_set_en_Female_en-US-AnaNeural",
+        edge.voice_set,
+        ["en", "Female", "en-US-AnaNeural"],
+    ),
+    ("styles_menu", edge.styles_menu, []),
+    ("style_set_creative", edge.style_set, ["creative"]),
+    ("response_2", edge.response, ["2"]),
+    ("tts_send_a1b2c3d4e5_3", edge.tts_send, ["a1b2c3d4e5", "3"]),
+    ("tts_menu", edge.tts_menu, []),
+    ("tts_toggle", edge.tts_toggle, []),
+    ("backends_menu", edge.backends_menu, []),
+    ("backend_menu_asr", edge.backend_menu, ["asr"]),
+    ("backend_set_asr_local", edge.backend_set, ["asr", "local"]),
+    ("cookies_menu", edge.cookies_menu, []),
+    ("cookie_set_cookies", edge.cookie_set, ["cookies"]),
+    ("cookie_set_my_cookies", edge.cookie_set, ["my_cookies"]),
+    (
+        "inline_0_0b6e4e4b-5b1e-4d8e-9b0e-2f0c1d3e4f5a_-1",
+        edge.inline,
+        [0, "0b6e4e4b-5b1e-4d8e-9b0e-2f0c1d3e4f5a", -1],
+    ),
+    (
+        "inline_0_0b6e4e4b-5b1e-4d8e-9b0e-2f0c1d3e4f5a_-1_123456789",
+        edge.inline,
+        [0, "0b6e4e4b-5b1e-4d8e-9b0e-2f0c1d3e4f5a", -1, 123456789],
+    ),
+    ("nop", None, None),
+]
+
+
+def legacy(data: str) -> str:
+    # Comparison chain of the previous button_handler
+    if data == "conv_new":
+        return "conv_new"
+    for prefix in (
+        "conv_set",
+        "conv_delete",
+        "conv_export",
+        "settings_menu",
+        "langs_menu",
+        "genders_menu",
+        "voices_menu",
+        "voice_set",
+        "styles_menu",
+        "style_set",
+        "response",
+        "tts_send",
+        "tts_menu",
+        "tts_toggle",
+        "backends_menu",
+        "backend_menu",
+        "backend_set",
+        "cookies_menu",
+        "cookie_set",
+        "inline",
+    ):
+        if data.startswith(prefix):
+            return prefix, data.split("_")
+
+
+def check() -> None:
+    for data, func, args in MATRIX:
+        handler = edge.parse_callback(data)
+        if func is None:
+            assert handler is None, data
+        else:
+            assert handler == (func, args), (data, handler)
+    print(f"{len(MATRIX)} callbacks routed correctly")
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="callbacks-benchmark",
+        description="Check and measure callback query dispatch",
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=20000,
+        help="Dispatches of every callback. Default: 20000",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    check()
+    callbacks = [data for data, _, _ in MATRIX]
+    for name, func in (
+        ("router", edge.parse_callback),
+        ("legacy", legacy),
+    ):
+        elapsed = min(
+            timeit.repeat(
+                lambda: [func(data) for data in callbacks],
+                number=args.number,
+                repeat=3,
+            )
+        )
+        print(
+            f"{name}: {args.number * len(callbacks) / elapsed:,.0f} "
+            f"dispatches/s"
+        )
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+from itertools import count
+from pathlib import Path
+from types import SimpleNamespace
+from uuid import uuid4
+
+import assemblyai as mock
+
+from aiohttp import web
+from EdgeGPT import EdgeGPT as edgegpt
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import backend  # noqa: E402
+import database as db  # noqa: E402
+import edge  # noqa: E402
+
+import sessions  # noqa: E402
+import utils as ut  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, ApplicationBuilder  # noqa: E402
+
+TOKEN = "123456:loadtest"
+FIRST_CHAT = 10**9
+BOT = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Bing",
+    "username": "loadtest_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": True,
+}
+WORDS = (
+    "Bing answers stream in small chunks while the search results are "
+    "summarized, **citing** sources like this[^1^] and sometimes adding "
+    "`inline code` or longer explanations that span several sentences "
+    "before the final message arrives with suggestions[^2^]."
+).split()
+ACTIONS = ("message",) * 7 + ("voice",) * 3 + ("button",) * 2
+STATS = {"edits": 0, "requests": 0}
+EVENTS = {}
+IDS = count(1)
+
+
+def message(cid: int, **fields: str) -> dict:
+    return {
+        "message_id": next(IDS),
+        "date": int(time.time()),
+        "chat": {"id": cid, "type": "private"},
+        "from": {"id": cid, "is_bot": False, "first_name": "Load"},
+        **fields,
+    }
+
+
+async def bot_api(request: web.Request) -> web.Response:
+    method = request.match_info["method"]
+    params = dict(await request.post())
+    STATS["requests"] += 1
+    result = True
+    if method == "getMe":
+        result = BOT
+    elif method == "getFile":
+        result = {
+            "file_id": params["file_id"],
+            "file_unique_id": params["file_id"],
+            "file_path": f"voice/{params['file_id']}",
+        }
+    elif method.startswith(("send", "edit")) and method != "sendChatAction":
+        cid = int(params["chat_id"])
+        if method.startswith("edit"):
+            STATS["edits"] += 1
+        if cid in EVENTS:
+            EVENTS[cid].put_nowait((method, params))
+        result = message(cid, text=params.get("text", ""))
+        if "message_id" in params:
+            result["message_id"] = int(params["message_id"])
+    return web.json_response({"ok": True, "result": result})
+
+
+async def voice_file(request: web.Request) -> web.Response:
+    duration = int(request.match_info["name"].split("_")[-1])
+    return web.Response(body=bytes(duration * mock.BYTES_PER_SECOND))
+
+
+def final(prompt: str, text: str, messages: int) -> dict:
+    return {
+        "item": {
+            "result": {"value": "Success"},
+            "throttling": {
+                "numUserMessagesInConversation": messages,
+                "maxNumUserMessagesInConversation": 30,
+            },
+            "messages": [
+                {"author": "user", "text": prompt},
+                {
+                    "author": "bot",
+                    "text": text,
+                    "contentOrigin": "DeepLeo",
+                    "sourceAttributions": [
+                        {"seeMoreUrl": "https://example.com/1"},
+                        {"seeMoreUrl": "https://example.com/2"},
+                    ],
+                    "suggestedResponses": [
+                        {"text": "Tell me more"},
+                        {"text": "Give me an example"},
+                    ],
+                },
+            ],
+        }
+    }
+
+
+class FakeChatbot:
+    def __init__(self, *args, **kwargs) -> None:
+        self.chat_hub = SimpleNamespace(
+            request=SimpleNamespace(
+                conversation_id=f"51D|{uuid4().hex}|{uuid4().hex}"
+            )
+        )
+        self.messages = 0
+
+    async def ask_stream(self, prompt: str, **kwargs):
+        self.messages += 1
+        await asyncio.sleep(ARGS.first)
+        prefix = (
+            f"Searching the web for: `{prompt}`\n\n"
+            f"Generating answers for you...\n\n"
+        )
+        for idx in range(1, len(WORDS) + 1, ARGS.words):
+            yield False, prefix + " ".join(WORDS[:idx])
+            await asyncio.sleep(ARGS.delay)
+        yield True, final(prompt, " ".join(WORDS), self.messages)
+
+    async def close(self) -> None:
+        pass
+
+    async def delete_conversation(self) -> None:
+        pass
+
+
+def answered(method: str, params: dict) -> bool:
+    return method == "editMessageText" and "conv_export" in params.get(
+        "reply_markup", ""
+    )
+
+
+def edited(method: str, params: dict) -> bool:
+    return method == "editMessageText"
+
+
+async def wait(cid: int, done) -> None:
+    while True:
+        method, params = await EVENTS[cid].get()
+        if done(method, params):
+            return
+
+
+async def chat(put, cid: int, rng: random.Random, latency: dict) -> None:
+    for _ in range(ARGS.messages):
+        action = rng.choice(ACTIONS)
+        done = answered
+        if action == "message":
+            data = {"message": message(cid, text=rng.choice(WORDS))}
+        elif action == "voice":
+            duration = rng.randint(2, 30)
+            data = {
+                "message": message(
+                    cid,
+                    voice={
+                        "file_id": f"{uuid4().hex}_{duration}",
+                        "file_unique_id": uuid4().hex,
+                        "duration": duration,
+                    },
+                )
+            }
+        else:
+            data = {
+                "callback_query": {
+                    "id": str(next(IDS)),
+                    "from": {"id": cid, "is_bot": False, "first_name": "L"},
+                    "chat_instance": str(cid),
+                    "data": "styles_menu",
+                    "message": message(cid, text="Conversation styles:"),
+                }
+            }
+            done = edited
+        data["update_id"] = next(IDS)
+        start = time.perf_counter()
+        await put(data)
+        try:
+            await asyncio.wait_for(wait(cid, done), ARGS.timeout)
+        except asyncio.TimeoutError:
+            latency["timeout"].append(ARGS.timeout)
+        else:
+            latency[action].append(time.perf_counter() - start)
+
+
+async def loop_lag(samples: list, interval: float = 0.01) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def percentiles(values: list) -> str:
+    if not values:
+        return "-"
+    values = sorted(values)
+    return ", ".join(
+        f"p{pc} {values[min(len(values) - 1, len(values) * pc // 100)]:.3f}s"
+        for pc in (50, 90, 99)
+    )
+
+
+async def start_fakes(port: int) -> web.AppRunner:
+    server = web.Application(client_max_size=0)
+    server.add_routes(
+        [
+            web.post(f"/bot{TOKEN}/{{method}}", bot_api),
+            web.get(f"/file/bot{TOKEN}/voice/{{name}}", voice_file),
+            web.post("/upload", mock.upload),
+            web.post("/transcript", mock.transcript),
+            web.get("/transcript/{tid}", mock.status),
+        ]
+    )
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    backend.ASR_API = f"http://127.0.0.1:{port}"
+    return runner
+
+
+async def start_bot(port: int, cids: list) -> Application:
+    for cid in cids:
+        ut.unlock(cid)
+        db.set_asr_backend(cid, "assemblyai")
+        EVENTS[cid] = asyncio.Queue()
+    url = f"http://127.0.0.1:{port}"
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .base_url(f"{url}/bot")
+        .base_file_url(f"{url}/file/bot")
+        .concurrent_updates(True)
+        .build()
+    )
+    edge.setup_handlers(app)
+    await app.initialize()
+    await app.start()
+    return app
+
+
+async def stop(app: Application, runner: web.AppRunner) -> None:
+    await app.stop()
+    await app.shutdown()
+    backend.stop_image_workers()
+    await sessions.close()
+    await runner.cleanup()
+
+
+def configure(tmp: str) -> None:
+    ut.PATH.update(dir=tmp, database="edge.db", config="config.json")
+    ut.path("config").write_text(
+        json.dumps(
+            {
+                "settings": {"token": TOKEN, "webhook": False},
+                "apis": {"openai": "openai_token", "assemblyai": "mock"},
+                "chats": {
+                    "password": "",
+                    "id": [],
+                    "admin": [],
+                    "remove_chats_on_stop": False,
+                    "history": False,
+                },
+                "cookies": [],
+            }
+        )
+    )
+    ut.setup()
+
+
+async def run() -> None:
+    runner = await start_fakes(ARGS.port)
+    edgegpt.Chatbot = FakeChatbot
+    cids = list(range(FIRST_CHAT, FIRST_CHAT + ARGS.chats))
+    app = await start_bot(ARGS.port, cids)
+    lag = []
+    monitor = asyncio.create_task(loop_lag(lag))
+    latency = {"message": [], "voice": [], "button": [], "timeout": []}
+    rng = random.Random(ARGS.seed)
+
+    async def put(data: dict) -> None:
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(chat(put, cid, random.Random(rng.random()), latency) for cid in cids)
+    )
+    elapsed = time.perf_counter() - start
+    monitor.cancel()
+    print(
+        f"{ARGS.chats} chats x {ARGS.messages} actions in {elapsed:.2f}s, "
+        f"{STATS['requests']} Bot API requests"
+    )
+    for action in ("message", "voice", "button"):
+        print(
+            f"  {action:<8} {len(latency[action]):>5}: "
+            f"{percentiles(latency[action])}"
+        )
+    print(f"  timeouts {len(latency['timeout']):>5}")
+    print(f"  edits/s  {STATS['edits'] / elapsed:.1f}")
+    print(f"  loop lag {percentiles(lag)}, max {max(lag, default=0):.3f}s")
+    await stop(app, runner)
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="loadtest",
+        description=(
+            "Drive the bot handlers with simulated chats against a fake "
+            "Telegram Bot API and a fake Bing chat"
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--chats",
+        type=int,
+        default=50,
+        help="Concurrent chats. Default: 50",
+    )
+    parser.add_argument(
+        "-m",
+        "--messages",
+        type=int,
+        default=5,
+        help="Actions (messages, voice notes, buttons) per chat. Default: 5",
+    )
+    parser.add_argument(
+        "-f",
+        "--first",
+        type=float,
+        default=1.0,
+        help="Seconds until Bing streams the first chunk. Default: 1.0",
+    )
+    parser.add_argument(
+        "-d",
+        "--delay",
+        type=float,
+        default=0.1,
+        help="Seconds between streamed chunks. Default: 0.1",
+    )
+    parser.add_argument(
+        "-w",
+        "--words",
+        type=int,
+        default=3,
+        help="Words added by every streamed chunk. Default: 3",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for every action. Default: 60",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed. Default: 0",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=8089,
+        help="Fake servers port. Default: 8089",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGS = setup_parser()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure(tmp)
+        asyncio.run(run())
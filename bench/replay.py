@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+
+import loadtest as fake
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import utils as ut  # noqa: E402
+from telegram import Update  # noqa: E402
+
+FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit "
+DEFAULT = {"chunks": [[1.0, 200]], "result": "Success", "length": 400}
+STREAMS = defaultdict(deque)
+CREATE = ut.create_conversation
+
+
+def filler(length: int) -> str:
+    return (FILLER * (length // len(FILLER) + 1))[:length]
+
+
+class ReplayChatbot(fake.FakeChatbot):
+    chat = None
+
+    async def ask_stream(self, prompt: str, **kwargs):
+        self.messages += 1
+        queue = STREAMS.get(self.chat)
+        record = queue.popleft() if queue else DEFAULT
+        elapsed = 0
+        for offset, length in record["chunks"]:
+            await asyncio.sleep(max(0, offset - elapsed) / ARGS.speed)
+            elapsed = offset
+            yield False, filler(length)
+        if record["result"] != "Success":
+            yield True, {
+                "item": {
+                    "result": {"value": record["result"], "error": "replay"}
+                }
+            }
+        else:
+            yield True, fake.final(
+                prompt, filler(record["length"]), self.messages
+            )
+
+
+async def create_conversation(update: Update, chat: tuple = None) -> str:
+    if chat is None:
+        chat = ut.conv_key(update)
+    conv_id = await CREATE(update, chat)
+    if conv_id:
+        ut.CONV["all"][chat][conv_id][0].chat = chat[1]
+    return conv_id
+
+
+def load(path: str) -> list:
+    updates = []
+    offset = last = 0
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record["t"] < last:  # recording restarted
+                offset += last
+            last = record["t"]
+            record["t"] += offset
+            if record["type"] == "update":
+                chat = Update.de_json(record["update"], None).effective_chat
+                record["chat"] = chat.id if chat is not None else None
+                updates.append(record)
+            elif record["type"] == "stream":
+                STREAMS[record["chat"]].append(record)
+    return updates
+
+
+def expects_answer(data: dict) -> bool:
+    msg = data.get("message")
+    if msg is None:
+        return False
+    private = msg["chat"]["type"] == "private"
+    if not private and "reply_to_message" not in msg:
+        return False
+    return "voice" in msg or not msg.get("text", "/").startswith("/")
+
+
+def prepare(data: dict) -> dict:
+    voice = data.get("message", {}).get("voice")
+    if voice is not None:  # fake file server reads the duration from its id
+        voice["file_id"] = f"{voice['file_id']}_{voice.get('duration', 1)}"
+    return data
+
+
+async def answers(cid: int, pending: deque, latency: list) -> None:
+    while True:
+        method, params = await fake.EVENTS[cid].get()
+        if fake.answered(method, params) and pending:
+            latency.append(time.perf_counter() - pending.popleft())
+
+
+async def run(updates: list) -> None:
+    runner = await fake.start_fakes(ARGS.port)
+    fake.edgegpt.Chatbot = ReplayChatbot
+    ut.create_conversation = create_conversation
+    cids = {rec["chat"] for rec in updates if rec["chat"] is not None}
+    app = await fake.start_bot(ARGS.port, cids)
+    pending = {cid: deque() for cid in cids}
+    latency = []
+    tasks = [
+        asyncio.create_task(answers(cid, pending[cid], latency))
+        for cid in cids
+    ]
+    lag = []
+    monitor = asyncio.create_task(fake.loop_lag(lag))
+    start = time.perf_counter()
+    first = updates[0]["t"] if updates else 0
+    for record in updates:
+        delay = (record["t"] - first) / ARGS.speed - (
+            time.perf_counter() - start
+        )
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update = Update.de_json(prepare(record["update"]), app.bot)
+        if expects_answer(record["update"]):
+            pending[record["chat"]].append(time.perf_counter())
+        await app.update_queue.put(update)
+    deadline = time.perf_counter() + ARGS.timeout
+    while any(pending.values()) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - start
+    monitor.cancel()
+    for task in tasks:
+        task.cancel()
+    print(
+        f"{len(updates)} updates from {len(cids)} chats replayed at "
+        f"{ARGS.speed}x in {elapsed:.2f}s"
+    )
+    print(f"  answers  {len(latency):>5}: {fake.percentiles(latency)}")
+    print(f"  missing  {sum(map(len, pending.values())):>5}")
+    print(f"  edits/s  {fake.STATS['edits'] / elapsed:.1f}")
+    print(
+        f"  loop lag {fake.percentiles(lag)}, max {max(lag, default=0):.3f}s"
+    )
+    await fake.stop(app, runner)
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="replay",
+        description=(
+            "Replay updates recorded with edge.py --record against a fake "
+            "Telegram Bot API and Bing chat following recorded timings"
+        ),
+    )
+    parser.add_argument("record", help="JSONL file written by --record")
+    parser.add_argument(
+        "-s",
+        "--speed",
+        type=float,
+        default=1,
+        help="Replay speed factor, e.g. 10 to replay 10x faster. Default: 1",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for pending answers at the end. Default: 60",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=8089,
+        help="Fake servers port. Default: 8089",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGS = setup_parser()
+    with tempfile.TemporaryDirectory() as tmp:
+        fake.configure(tmp)
+        asyncio.run(run(load(ARGS.record)))
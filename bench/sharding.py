@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+import loadtest as fake
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import backend  # noqa: E402
+import database as db  # noqa: E402
+import edge  # noqa: E402
+import sessions  # noqa: E402
+import shard  # noqa: E402
+import utils as ut  # noqa: E402
+from telegram.ext import Application, ApplicationBuilder  # noqa: E402
+
+
+def build(port: int) -> Application:
+    url = f"http://127.0.0.1:{port}"
+    backend.ASR_API = url
+    fake.edgegpt.Chatbot = fake.FakeChatbot
+    for cid in range(fake.FIRST_CHAT, fake.FIRST_CHAT + ARGS.chats):
+        ut.unlock(cid)
+        db.set_asr_backend(cid, "assemblyai")
+    app = (
+        ApplicationBuilder()
+        .token(fake.TOKEN)
+        .base_url(f"{url}/bot")
+        .base_file_url(f"{url}/file/bot")
+        .concurrent_updates(True)
+        .updater(None)
+        .build()
+    )
+    edge.setup_handlers(app)
+    return app
+
+
+async def ready(session: aiohttp.ClientSession, port: int) -> None:
+    while True:
+        try:
+            async with session.get(f"http://127.0.0.1:{port}/"):
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+
+
+async def measure(workers: int) -> None:
+    ports = [ARGS.port + 2 + idx for idx in range(workers)]
+    procs = [
+        subprocess.Popen(
+            [sys.executable, __file__, *sys.argv[1:], "--worker", str(port)]
+        )
+        for port in ports
+    ]
+    stop = asyncio.Event()
+    dispatcher = asyncio.create_task(
+        shard.dispatch(
+            "127.0.0.1", ARGS.port + 1, fake.TOKEN, ports, stop=stop
+        )
+    )
+    url = f"http://127.0.0.1:{ARGS.port + 1}/{fake.TOKEN}"
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(ready(session, port) for port in ports))
+
+        async def put(data: dict) -> None:
+            async with session.post(url, json=data) as resp:
+                resp.raise_for_status()
+
+        cids = range(fake.FIRST_CHAT, fake.FIRST_CHAT + ARGS.chats)
+        latency = {"message": [], "voice": [], "button": [], "timeout": []}
+        rng = random.Random(ARGS.seed)
+        requests = fake.STATS["requests"]
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                fake.chat(put, cid, random.Random(rng.random()), latency)
+                for cid in cids
+            )
+        )
+        elapsed = time.perf_counter() - start
+    stop.set()
+    await dispatcher
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        proc.wait()
+    done = sum(
+        len(latency[action]) for action in ("message", "voice", "button")
+    )
+    print(
+        f"{workers} workers: {done / elapsed:>7.1f} actions/s, "
+        f"{(fake.STATS['requests'] - requests) / elapsed:>7.1f} "
+        f"Bot API requests/s, message {fake.percentiles(latency['message'])}"
+        f", timeouts {len(latency['timeout'])}"
+    )
+
+
+async def run() -> None:
+    print(
+        f"{ARGS.chats} chats x {ARGS.messages} actions, "
+        f"{os.cpu_count()} CPUs"
+    )
+    runner = await fake.start_fakes(ARGS.port)
+    for cid in range(fake.FIRST_CHAT, fake.FIRST_CHAT + ARGS.chats):
+        fake.EVENTS[cid] = asyncio.Queue()
+    for workers in ARGS.workers:
+        await measure(workers)
+    await runner.cleanup()
+
+
+async def work(port: int) -> None:
+    await shard.serve({"": build(ARGS.port)}, "127.0.0.1", port)
+    backend.stop_image_workers()
+    await sessions.close()
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="sharding",
+        description=(
+            "Measure throughput of the sharded bot: a dispatcher routing "
+            "updates by chat to N worker processes, against a fake "
+            "Telegram Bot API and a fake Bing chat"
+        ),
+    )
+    parser.add_argument(
+        "-n",
+        "--workers",
+        type=lambda value: [int(n) for n in value.split(",")],
+        default=[1, 2, 4, 8],
+        help="Comma separated worker counts. Default: 1,2,4,8",
+    )
+    parser.add_argument(
+        "-c",
+        "--chats",
+        type=int,
+        default=200,
+        help="Concurrent chats. Default: 200",
+    )
+    parser.add_argument(
+        "-m",
+        "--messages",
+        type=int,
+        default=5,
+        help="Actions (messages, voice notes, buttons) per chat. Default: 5",
+    )
+    parser.add_argument(
+        "-f",
+        "--first",
+        type=float,
+        default=0.1,
+        help="Seconds until Bing streams the first chunk. Default: 0.1",
+    )
+    parser.add_argument(
+        "-d",
+        "--delay",
+        type=float,
+        default=0.01,
+        help="Seconds between streamed chunks. Default: 0.01",
+    )
+    parser.add_argument(
+        "-w",
+        "--words",
+        type=int,
+        default=1,
+        help="Words added by every streamed chunk. Default: 1",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=60,
+        help="Seconds to wait for every action. Default: 60",
+    )
+    parser.add_argument(
+        "-s",
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed. Default: 0",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=8089,
+        help=(
+            "Fake servers port, the dispatcher and workers use the "
+            "following ones. Default: 8089"
+        ),
+    )
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    ARGS = fake.ARGS = setup_parser()
+    with tempfile.TemporaryDirectory() as tmp:
+        fake.configure(tmp)
+        if ARGS.worker is None:
+            asyncio.run(run())
+        else:
+            asyncio.run(work(ARGS.worker))
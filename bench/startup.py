@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1].joinpath("src")
+IMPORT = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+LAZY = (
+    "openai",
+    "edge_tts",
+    "EdgeGPT",
+    "faster_whisper",
+    "PIL",
+    "aiohttp.web",
+)
+
+
+def importtime() -> dict:
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, (str(SRC), env.get("PYTHONPATH")))
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import edge"],
+        env=env,
+        cwd=SRC,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORT.match(line)
+        if match is not None:
+            _, cumulative, indent, name = match.groups()
+            modules[name] = (int(cumulative), len(indent))
+    return modules
+
+
+def version() -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, str(SRC.joinpath("edge.py")), "--version"],
+        capture_output=True,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="startup-benchmark",
+        description=(
+            "Measure the bot import time with python -X importtime "
+            "and fail when it exceeds a budget"
+        ),
+    )
+    parser.add_argument(
+        "-n",
+        "--number",
+        type=int,
+        default=5,
+        help="Runs, the median is reported. Default: 5",
+    )
+    parser.add_argument(
+        "-b",
+        "--budget",
+        type=float,
+        default=750,
+        help="Maximum import time of edge.py in ms. Default: 750",
+    )
+    parser.add_argument(
+        "-t",
+        "--top",
+        type=int,
+        default=10,
+        help="Slowest packages shown. Default: 10",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    runs = [importtime() for _ in range(args.number)]
+    total = statistics.median(run["edge"][0] for run in runs) / 1000
+    modules = runs[-1]
+    print(f"import edge: {total:.1f} ms (budget {args.budget:.0f} ms)")
+    top = sorted(
+        (
+            (cumulative, name)
+            for name, (cumulative, _) in modules.items()
+            if "." not in name and name not in ("edge", "site")
+        ),
+        reverse=True,
+    )
+    for cumulative, name in top[: args.top]:
+        print(f"  {name:<32} {cumulative / 1000:>8.1f} ms")
+    eager = sorted(
+        lazy
+        for lazy in LAZY
+        if any(name == lazy or name.startswith(f"{lazy}.") for name in modules)
+    )
+    if eager:
+        print(f"modules expected to load lazily: {', '.join(eager)}")
+    elapsed = statistics.median(version() for _ in range(args.number))
+    print(f"edge.py --version: {elapsed * 1000:.1f} ms")
+    sys.exit(1 if total > args.budget or eager else 0)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import json
+import random
+import sys
+import timeit
+from functools import partial
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import backend  # noqa: E402
+
+import utils as ut  # noqa: E402
+
+SIZES = (100, 1000, 5000, 20000)
+SENTENCES = (
+    "Python is a high-level programming language[^{ref}^].",
+    "It emphasizes **code readability** with significant indentation.",
+    "You can install packages with `pip install` and _virtual envs_.",
+    "The standard library covers __networking__, files and threads[^{ref}^].",
+    "Use `asyncio` to run *concurrent* coroutines in a single thread.",
+    "According to the documentation[^{ref}^], this is supported since 3.7.",
+)
+CODE = (
+    "```python\n"
+    "import asyncio\n\n\n"
+    "async def main() -> None:\n"
+    "    await asyncio.sleep(1)  # `sleep` **does not** block\n"
+    "    print([x * 2 for x in range(10)])\n\n\n"
+    "asyncio.run(main())\n"
+    "```\n"
+)
+
+
+def answer(kind: str, size: int, rng: random.Random) -> str:
+    parts = []
+    length = 0
+    refs = 0
+    while length < size:
+        if kind == "code" and rng.random() < 0.3:
+            part = CODE
+        else:
+            if kind == "refs" or refs < 3:
+                refs += 1
+            part = f"{rng.choice(SENTENCES).format(ref=refs)} "
+            if kind == "refs":
+                part = f"{part}See also[^{refs}^]. "
+        parts.append(part)
+        length += len(part)
+    definitions = "".join(
+        f"\n[^{idx}^]: https://example.com/{idx}" for idx in range(1, refs + 1)
+    )
+    return "".join(parts)[:size] + definitions
+
+
+def stream(text: str) -> str:
+    return (
+        "Searching the web for: `python asyncio`\n\n"
+        "Generating answers for you...\n\n"
+        f"{text}\n"
+        '```json\n{"web_search_results": []}\n```'
+    )
+
+
+def corpus(seed: int) -> dict:
+    rng = random.Random(seed)
+    return {
+        f"{kind}-{size}": answer(kind, size, rng)
+        for kind in ("prose", "code", "refs")
+        for size in SIZES
+    }
+
+
+def references(text: str) -> str:
+    links = {
+        str(idx): f"https://example.com/{idx}"
+        for idx in range(1, text.count("[^") + 1)
+    }
+    return backend.REF.sub(partial(ut.generate_link, references=links), text)
+
+
+FUNCS = {
+    "markdown_to_html": backend.markdown_to_html,
+    "parse_code": lambda text: list(backend.parse_code(text)),
+    "clean_stream": lambda text: backend.clean_stream(stream(text)),
+    "references": references,
+}
+
+
+def measure(texts: dict, funcs: list, repeat: int) -> dict:
+    results = {}
+    for name in funcs:
+        for case, text in texts.items():
+            timer = timeit.Timer(partial(FUNCS[name], text))
+            number, _ = timer.autorange()
+            best = min(timer.repeat(repeat, number)) / number
+            results[f"{name}/{case}"] = best
+    return results
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="text-benchmark",
+        description=(
+            "Measure backend text processing on synthetic Bing answers "
+            "(prose, code-heavy and reference-heavy, 100 B to 20 KB)"
+        ),
+    )
+    parser.add_argument(
+        "-f",
+        "--functions",
+        nargs="+",
+        choices=list(FUNCS),
+        default=list(FUNCS),
+        help="Functions to measure. Default: all",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=5,
+        help="Repetitions, the best one is reported. Default: 5",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Corpus random seed. Default: 0",
+    )
+    parser.add_argument(
+        "-s",
+        "--save",
+        help="Store results in a JSON file to compare future runs",
+    )
+    parser.add_argument(
+        "-c",
+        "--compare",
+        help="Compare with results stored by a previous run",
+    )
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=10,
+        help="Slowdown percentage reported as regression. Default: 10",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    results = measure(corpus(args.seed), args.functions, args.repeat)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = 0
+    for case, elapsed in results.items():
+        line = f"{case:<32} {elapsed * 1e6:>10.1f} µs"
+        if case in baseline:
+            change = (elapsed / baseline[case] - 1) * 100
+            line = f"{line} {change:>+7.1f}%"
+            if change > args.threshold:
+                line = f"{line} REGRESSION"
+                regressions += 1
+        print(line)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import argparse
+import asyncio
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+import assemblyai as mock
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import backend  # noqa: E402
+
+import sessions  # noqa: E402
+import utils as ut  # noqa: E402
+
+# Telegram voice notes are opus encoded at ~32 kbps
+BYTES_PER_SECOND = 4000
+
+
+async def voice_file(request: web.Request) -> web.StreamResponse:
+    size = int(request.match_info["size"])
+    resp = web.StreamResponse()
+    resp.content_length = size
+    await resp.prepare(request)
+    chunk = bytes(backend.CHUNK_SIZE)
+    for idx in range(0, size, backend.CHUNK_SIZE):
+        await resp.write(chunk[: size - idx])
+    await resp.write_eof()
+    return resp
+
+
+async def buffered(url: str) -> str:
+    async with sessions.get("telegram").get(url) as resp:
+        data = bytearray(await resp.read())
+    return await backend.asr_assemblyai(data)
+
+
+async def streamed(url: str) -> str:
+    file = SimpleNamespace(file_path=url)
+    return await backend.asr_assemblyai(backend.download_stream(file))
+
+
+async def run(notes: int, duration: int, port: int, mode: str) -> None:
+    app = web.Application(client_max_size=0)
+    app.add_routes(
+        [
+            web.get("/file/{size}", voice_file),
+            web.post("/upload", mock.upload),
+            web.post("/transcript", mock.transcript),
+            web.get("/transcript/{tid}", mock.status),
+        ]
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    backend.ASR_API = f"http://127.0.0.1:{port}"
+    mock.PROCESSING_RATIO = 0
+    url = f"{backend.ASR_API}/file/{duration * BYTES_PER_SECOND}"
+    func = streamed if mode == "stream" else buffered
+    tracemalloc.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(func(url) for _ in range(notes)))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{mode}: {notes} notes of {duration}s in {elapsed:.2f}s, "
+        f"peak traced memory {peak / 2**20:.1f} MiB"
+    )
+    await sessions.close()
+    await runner.cleanup()
+
+
+def setup_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="voice-memory-benchmark",
+        description=(
+            "Measure memory used by concurrent voice notes "
+            "downloaded from Telegram and uploaded to AssemblyAI"
+        ),
+    )
+    parser.add_argument(
+        "-n",
+        "--notes",
+        type=int,
+        default=50,
+        help="Concurrent voice notes. Default: 50",
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=int,
+        default=300,
+        help="Voice note duration in seconds. Default: 300",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=8089,
+        help="Mock server port. Default: 8089",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=["stream", "buffer"],
+        default="stream",
+        help="Pipe downloads to the upload or buffer them. Default: stream",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    ut.DATA["config"] = {"apis": {"assemblyai": "mock"}}
+    asyncio.run(run(args.notes, args.duration, args.port, args.mode))
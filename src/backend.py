@@ -7,24 +7,28 @@ import asyncio
 import html
 import io
 import logging
+import multiprocessing
 import re
-import subprocess
 import tempfile
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import partial
 from pathlib import Path
-from typing import Any, Dict, Tuple, Union
+from typing import Any, AsyncIterator, Callable, Dict, List, Tuple, Union
 from uuid import uuid4
 
 import aiohttp
 
 import database as db
-import edge_tts
-import openai
+import metrics
+import recorder
+import sessions
+import shard
+import tracing
 import utils as ut
-from aiohttp.web import HTTPException
-from EdgeGPT.EdgeGPT import ConversationStyle
-from telegram import constants, InputMediaPhoto, Update
+from telegram import constants, File, InputMediaPhoto, Message, Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
@@ -44,8 +48,26 @@ SRCH_RESP = re.compile(r"Searching the web for.*")
 JSON_RESP = re.compile(r"```json(.*?)```", re.DOTALL)
 IMG_RESP = re.compile(r"!\[image\d+\]\((.*?)\)")
 ASR_API = "https://api.assemblyai.com/v2"
+ASR_ERROR = "Could not connect to AssemblyAI API. Try again later."
+ASR_POLL_MIN = 0.5
+ASR_POLL_MAX = 5
+ASR_POLL_RATIO = 0.2
 EDIT_DELAY = 0.5
 CHAT_LIMIT = 3080
+CHUNK_SIZE = 64 * 1024
+ASR_POOL = {"local": None}
+LOCAL_MODEL = None
+IMAGE_TTL = 3600
+IMAGES = ut.Cache(IMAGE_TTL, 256)
+IMAGE_TASKS = {}
+IMAGE_WINDOW = 3600
+IMAGE_RETRIES = 3
+IMAGE_TIMEOUT = 30
+IMAGE_MAX_SIZE = 10 * 1024 * 1024
+IMAGE_MAX_SIDE = 2560
+IMAGE_MAGIC = (b"\xff\xd8\xff", b"\x89PNG", b"RIFF", b"GIF8")
+IMAGE_USAGE = {}
+IMAGE_POOL = {"queue": None, "workers": [], "busy": 0}
 
 
 def parse_code(text: str) -> Union[Tuple[int, int, int, int], None]:
@@ -95,6 +117,16 @@ def markdown_to_html(text: str) -> str:
     return "".join(not_code)
 
 
+def clean_stream(text: str) -> str:
+    text = JSON_RESP.sub("", text)
+    text = SRCH_RESP.sub("", text)
+    text = GEN_RESP.sub("\\1", text)
+    text = REF_INLINE_ST.sub("", text)
+    text = REF_ST.sub("", text)
+    return text.strip()
+
+
+@tracing.traced("tts")
 async def send_tts_audio(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -109,11 +141,14 @@ async def send_tts_audio(
     text = BOLD.sub("\\1\\2", text)
     if ut.DEBUG:
         logging.getLogger("Bot").info(f"\nMessage:\n{text}\n\n")
+    import edge_tts
+
     comm = edge_tts.Communicate(text, db.voice(ut.cid(update)))
     with io.BytesIO() as out:
-        async for message in comm.stream():
-            if message["type"] == "audio":
-                out.write(message["data"])
+        with metrics.TTS.time():
+            async for message in comm.stream():
+                if message["type"] == "audio":
+                    out.write(message["data"])
         out.seek(0)
         ut.delete_job(context, job_name)
         await update.effective_message.reply_voice(
@@ -121,82 +156,138 @@ async def send_tts_audio(
         )
 
 
+@tracing.traced("asr")
 async def automatic_speech_recognition(
-    cid: int, fid: str, data: bytearray
+    cid: int, fid: str, chunks: AsyncIterator[bytes], duration: int = 0
 ) -> Union[str, None]:
-    if "apis" not in ut.DATA["config"]:
+    text = None
+    if not ut.DATA["config"]["apis"]:
         logging.getLogger("Bot").error(
             "API section not defined. Check templates/config.json"
         )
-    else:
-        if db.asr_backend(cid) == "whisper":
+        return text
+    asr = db.asr_backend(cid)
+    tracing.annotate(backend=asr)
+    with metrics.ASR.time(backend=asr):
+        if asr == "whisper":
             if not ut.apis("openai").startswith("sk-"):
                 logging.getLogger("Bot").error("OpenAI token not defined")
             else:
-                return await asr_whisper(fid, data)
+                text = await asr_whisper(fid, chunks)
+        elif asr == "local":
+            text = await asr_local(chunks)
         else:
             if ut.apis("assemblyai") == "assemblyai_token":
                 logging.getLogger("Bot").error("AssemblyAI token not defined")
             else:
-                return await asr_assemblyai(data)
+                text = await asr_assemblyai(chunks, duration)
+    metrics.ASR_REQUESTS.inc(
+        backend=asr, result="error" if text in (None, ASR_ERROR) else "ok"
+    )
+    return text
+
+
+async def download_stream(file: File) -> AsyncIterator[bytes]:
+    if not file.file_path.startswith("http"):  # local bot api server
+        with open(file.file_path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+    else:
+        async with sessions.get("telegram").get(file.file_path) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                yield chunk
 
 
-async def asr_assemblyai(data: bytearray) -> str:
-    text = "Could not connect to AssemblyAI API. Try again later."
+async def asr_assemblyai(
+    data: Union[bytes, AsyncIterator[bytes]], duration: int = 0
+) -> str:
+    text = ASR_ERROR
+    session = sessions.get("assemblyai")
+    headers = {"authorization": ut.apis("assemblyai")}
     try:
-        async with aiohttp.ClientSession(
-            headers={"authorization": ut.apis("assemblyai")}
-        ) as session:
-            async with session.post(f"{ASR_API}/upload", data=data) as req:
-                resp = await req.json()
-                upload = {
-                    "audio_url": resp["upload_url"],
-                    "language_detection": True,
-                }
-            async with session.post(
-                f"{ASR_API}/transcript", json=upload
+        async with session.post(
+            f"{ASR_API}/upload", data=data, headers=headers
+        ) as req:
+            resp = await req.json()
+            upload = {
+                "audio_url": resp["upload_url"],
+                "language_detection": True,
+            }
+        async with session.post(
+            f"{ASR_API}/transcript", json=upload, headers=headers
+        ) as req:
+            resp = await req.json()
+        upload_id = resp["id"]
+        status = resp["status"]
+        delay = min(ASR_POLL_MAX, max(ASR_POLL_MIN, duration * ASR_POLL_RATIO))
+        while status not in ("completed", "error"):
+            await asyncio.sleep(delay)
+            delay = min(ASR_POLL_MAX, delay * 2)
+            async with session.get(
+                f"{ASR_API}/transcript/{upload_id}", headers=headers
             ) as req:
                 resp = await req.json()
-                upload_id = resp["id"]
                 status = resp["status"]
-                while status not in ("completed", "error"):
-                    async with session.get(
-                        f"{ASR_API}/transcript/{upload_id}"
-                    ) as req2:
-                        resp2 = await req2.json()
-                        status = resp2["status"]
-                        if ut.DEBUG:
-                            logging.getLogger("AssemblyAI").info(
-                                f"response: {resp2}"
-                            )
-                            logging.getLogger("AssemblyAI").info(
-                                f"{upload_id}: {status}"
-                            )
-                        await asyncio.sleep(5)
-                text = resp2["text"]
-    except HTTPException:
+                if ut.DEBUG:
+                    logging.getLogger("AssemblyAI").info(f"response: {resp}")
+                    logging.getLogger("AssemblyAI").info(
+                        f"{upload_id}: {status}"
+                    )
+        text = resp["text"]
+    except aiohttp.ClientError:
         pass
     return text
 
 
-async def asr_whisper(fid: str, data: bytearray) -> str:
+async def asr_whisper(fid: str, chunks: AsyncIterator[bytes]) -> str:
     text = None
-    with tempfile.NamedTemporaryFile(suffix=".oga", delete=False) as inp:
-        inp.write(data)
     with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as out:
         pass
+    converted = False
     try:
-        subprocess.run(
-            ["ffmpeg", "-y", "-i", inp.name, out.name],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-y",
+            "-i",
+            "pipe:0",
+            out.name,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
         )
-    except:  # noqa
+    except OSError as e:
         logging.getLogger("FFmpeg").error(
-            "Could not convert .oga voice file to .mp3. Check ffmpeg binary"
+            f"Could not run ffmpeg: {e}. Check ffmpeg binary"
         )
     else:
+        try:
+            async for chunk in chunks:
+                try:
+                    proc.stdin.write(chunk)
+                    await proc.stdin.drain()
+                except ConnectionError:
+                    break
+            proc.stdin.close()
+            converted = not await proc.wait()
+            if not converted:
+                logging.getLogger("FFmpeg").error(
+                    f"Could not convert .oga voice file to .mp3, "
+                    f"ffmpeg exited with code {proc.returncode}"
+                )
+        except Exception as e:  # noqa
+            logging.getLogger("Bot").error(
+                f"Could not download voice file {fid}: {e}"
+            )
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+    if converted:
+        import openai
+
         openai.api_key = ut.apis("openai")
+        openai.aiosession.set(sessions.get("openai"))
         try:
             with open(out.name, "rb") as f:
                 resp = await openai.Audio.atranscribe("whisper-1", f)
@@ -205,11 +296,261 @@ async def asr_whisper(fid: str, data: bytearray) -> str:
             logging.getLogger("Bot").error("Invalid OpenAI credentials")
         except Exception as e:
             logging.getLogger("OpenAI").error(e)
-    Path(inp.name).unlink()
     Path(out.name).unlink()
     return text
 
 
+def _local_model(model: str, compute_type: str) -> None:
+    global LOCAL_MODEL
+    from faster_whisper import WhisperModel
+
+    LOCAL_MODEL = WhisperModel(model, device="cpu", compute_type=compute_type)
+
+
+def _local_transcribe(voice: str) -> str:
+    segments, _ = LOCAL_MODEL.transcribe(voice, beam_size=1)
+    return " ".join(seg.text.strip() for seg in segments)
+
+
+def local_asr_pool() -> ProcessPoolExecutor:
+    if ASR_POOL["local"] is None:
+        ASR_POOL["local"] = ProcessPoolExecutor(
+            max_workers=int(ut.settings("asr_workers")),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_local_model,
+            initargs=(
+                ut.settings("asr_model"),
+                ut.settings("asr_compute_type"),
+            ),
+        )
+    return ASR_POOL["local"]
+
+
+def shutdown_asr() -> None:
+    if ASR_POOL["local"] is not None:
+        ASR_POOL["local"].shutdown(wait=False)
+        ASR_POOL["local"] = None
+
+
+async def asr_local(chunks: AsyncIterator[bytes]) -> Union[str, None]:
+    text = None
+    loop = asyncio.get_running_loop()
+    with tempfile.NamedTemporaryFile(suffix=".oga", delete=False) as inp:
+        pass
+    try:
+        with open(inp.name, "wb") as f:
+            async for chunk in chunks:
+                f.write(chunk)
+        text = await loop.run_in_executor(
+            local_asr_pool(), _local_transcribe, inp.name
+        )
+    except BrokenProcessPool:
+        logging.getLogger("Bot").error(
+            "Could not load local ASR model. Check faster-whisper package"
+        )
+        shutdown_asr()
+    except Exception as e:
+        logging.getLogger("LocalASR").error(e)
+    Path(inp.name).unlink()
+    if ut.DEBUG:
+        logging.getLogger("LocalASR").info(f"transcription: {text}")
+    return text
+
+
+def image_key(prompt: str) -> str:
+    return " ".join(prompt.casefold().split())
+
+
+def image_rate() -> int:
+    return max(1, int(ut.settings("image_rate")) // shard.SHARD["workers"])
+
+
+async def acquire_cookie() -> str:
+    while True:
+        now = time.monotonic()
+        rate = image_rate()
+        usage = {}
+        for cookie in ut.DATA["cookies"]["_U"]:
+            uses = IMAGE_USAGE.setdefault(cookie, deque())
+            while uses and uses[0] < now - IMAGE_WINDOW:
+                uses.popleft()
+            usage[cookie] = uses
+        available = [ck for ck, uses in usage.items() if len(uses) < rate]
+        if available:
+            cookie = min(available, key=lambda ck: len(usage[ck]))
+            usage[cookie].append(now)
+            return cookie
+        oldest = min(uses[0] for uses in usage.values() if uses)
+        await asyncio.sleep(oldest + IMAGE_WINDOW - now)
+
+
+async def image_worker() -> None:
+    from EdgeGPT.ImageGen import ImageGenAsync
+
+    queue = IMAGE_POOL["queue"]
+    while True:
+        prompt, key, future, queued = await queue.get()
+        IMAGE_POOL["busy"] += 1
+        cookie = "none"
+        try:
+            cookie = await acquire_cookie()
+            start = time.monotonic()
+            metrics.IMAGE_WAIT.observe(start - queued)
+            _u = ut.DATA["cookies"]["_U"][cookie]
+            async with sessions.client(
+                f"image_{cookie}", _u, partial(ImageGenAsync, _u, quiet=True)
+            ) as iga:
+                with metrics.IMAGE_GENERATION.time(cookie=cookie):
+                    images = await iga.get_images(prompt)
+        except Exception as e:  # noqa
+            metrics.IMAGE_REQUESTS.inc(cookie=cookie, result="error")
+            if not future.done():
+                future.set_exception(e)
+        else:
+            metrics.IMAGE_REQUESTS.inc(cookie=cookie, result="ok")
+            IMAGES.set(key, images)
+            future.set_result(images)
+            if ut.DEBUG:
+                logging.getLogger("BingImageCreator").info(
+                    f"{cookie}: waited {start - queued:.2f}s, "
+                    f"generated in {time.monotonic() - start:.2f}s"
+                )
+        finally:
+            IMAGE_POOL["busy"] -= 1
+            queue.task_done()
+
+
+def start_image_workers() -> None:
+    if not IMAGE_POOL["workers"]:
+        IMAGE_POOL["queue"] = asyncio.Queue()
+        for _ in range(int(ut.settings("image_workers"))):
+            IMAGE_POOL["workers"].append(asyncio.ensure_future(image_worker()))
+
+
+def stop_image_workers() -> None:
+    for worker in IMAGE_POOL["workers"]:
+        worker.cancel()
+    IMAGE_POOL["workers"].clear()
+    IMAGE_POOL["queue"] = None
+
+
+async def generate_images(prompt: str, notify: Callable = None) -> List[str]:
+    key = image_key(prompt)
+    images = IMAGES.get(key)
+    if images is not None:
+        metrics.CACHE.inc(cache="image", result="hit")
+    else:
+        future = IMAGE_TASKS.get(key)
+        if future is not None:
+            metrics.CACHE.inc(cache="image", result="shared")
+        else:
+            metrics.CACHE.inc(cache="image", result="miss")
+            start_image_workers()
+            future = asyncio.get_running_loop().create_future()
+            future.add_done_callback(lambda _: IMAGE_TASKS.pop(key, None))
+            IMAGE_TASKS[key] = future
+            await IMAGE_POOL["queue"].put(
+                (prompt, key, future, time.monotonic())
+            )
+            position = IMAGE_POOL["queue"].qsize() - (
+                len(IMAGE_POOL["workers"]) - IMAGE_POOL["busy"]
+            )
+            if notify is not None and position > 0:
+                try:
+                    await notify(position)
+                except Exception as e:  # noqa
+                    logging.getLogger("BingImageCreator").error(
+                        f"Could not notify queue position: {e}"
+                    )
+        images = await asyncio.shield(future)
+    return images
+
+
+def cache_images(prompt: str, messages: List[Message]) -> None:
+    file_ids = [msg.photo[-1].file_id for msg in messages if msg.photo]
+    if file_ids:
+        bot = messages[0].get_bot().id
+        IMAGES.set((bot, image_key(prompt)), file_ids)
+
+
+def prepare_image(data: bytes) -> Union[bytes, None]:
+    if not data.startswith(IMAGE_MAGIC):
+        return None
+    if len(data) > IMAGE_MAX_SIZE:
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+        with Image.open(io.BytesIO(data)) as img, io.BytesIO() as out:
+            img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+            img.convert("RGB").save(out, "JPEG", quality=90)
+            data = out.getvalue()
+    return data
+
+
+async def fetch_image(url: str) -> Union[bytes, None]:
+    loop = asyncio.get_running_loop()
+    for attempt in range(IMAGE_RETRIES):
+        try:
+            async with sessions.get("bing").get(
+                url, timeout=aiohttp.ClientTimeout(total=IMAGE_TIMEOUT)
+            ) as resp:
+                resp.raise_for_status()
+                data = await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.getLogger("BingImageCreator").error(
+                f"Could not download image ({attempt + 1}/{IMAGE_RETRIES}): "
+                f"{e}"
+            )
+            if attempt + 1 < IMAGE_RETRIES:
+                await asyncio.sleep(2**attempt)
+        else:
+            return await loop.run_in_executor(None, prepare_image, data)
+
+
+async def image_media(images: List[str]) -> List[InputMediaPhoto]:
+    if ut.settings("image_upload") and images[0].startswith("http"):
+        downloaded = await asyncio.gather(
+            *(fetch_image(img) for img in images)
+        )
+        media = [InputMediaPhoto(img) for img in downloaded if img is not None]
+        if media:
+            return media
+    return [InputMediaPhoto(img) for img in images]
+
+
+async def reply_images(
+    message: Message, images: List[str], caption: str
+) -> List[Message]:
+    start = time.monotonic()
+    media = await image_media(images)
+    fetched = time.monotonic()
+    messages = await message.reply_media_group(
+        media, caption=caption, parse_mode=ParseMode.HTML
+    )
+    if ut.DEBUG:
+        mode = "upload" if ut.settings("image_upload") else "url"
+        logging.getLogger("Bot").info(
+            f"{len(media)} images sent using {mode} mode: "
+            f"fetch {fetched - start:.2f}s, "
+            f"send {time.monotonic() - fetched:.2f}s"
+        )
+    return messages
+
+
+def uploaded_images(prompt: str, images: List[str], bot: int) -> List[str]:
+    file_ids = IMAGES.get((bot, image_key(prompt)))
+    if (
+        file_ids is not None
+        and len(file_ids) == len(images)
+        and not file_ids[0].startswith("http")
+    ):
+        metrics.CACHE.inc(cache="file_id", result="hit")
+        return file_ids
+    metrics.CACHE.inc(cache="file_id", result="miss")
+    return images
+
+
 class BingAI:
     def __init__(
         self,
@@ -226,6 +567,7 @@ class BingAI:
         self.inline = inline
         self.edit = None
         self.cid = ut.cid(self.update)
+        self.chat = ut.conv_key(self.update)
         if self.text is None:
             self.text = update.effective_message.text
         self.conv_id = None
@@ -235,12 +577,13 @@ class BingAI:
         self.user_msg = None
         self.user_msg_max = None
 
+    @tracing.traced("bing")
     async def run(self) -> None:
         if self.text.startswith("#note"):
             return
-        self.conv_id = ut.CONV["current"][self.cid]
-        if self.conv_id not in ut.CONV["all"][self.cid]:
-            self.conv_id = await ut.create_conversation(self.update, self.cid)
+        self.conv_id = ut.CONV["current"][self.chat]
+        if self.conv_id not in ut.CONV["all"][self.chat]:
+            self.conv_id = await ut.create_conversation(self.update, self.chat)
         if self.callback is not None:
             await ut.remove_button(self.update, self.callback)
         if not self.inline:
@@ -248,19 +591,27 @@ class BingAI:
                 self.update, f"<b>You</b>: {html.escape(self.text)}"
             )
             turn = str(uuid4())[:8]
-            ut.RUN[self.cid][self.conv_id].append(turn)
-            while turn != ut.RUN[self.cid][self.conv_id][0]:
-                await asyncio.sleep(5)
+            ut.RUN[self.chat][self.conv_id].append(turn)
+            with metrics.BING_QUEUE.time(), tracing.span("queue"):
+                while turn != ut.RUN[self.chat][self.conv_id][0]:
+                    await asyncio.sleep(5)
             job_name = ut.action_schedule(
                 self.update, self.context, constants.ChatAction.TYPING
             )
-        ut.CONV["all"][self.cid][self.conv_id][1] = self.text
-        start = time.time()
+        ut.CONV["all"][self.chat][self.conv_id][1] = self.text
+        cookie = ut.CONV["cookie"].get(self.conv_id, "none")
+        start = begin = time.time()
+        first = None
+        chunks = []
         edits = 0
         delay = EDIT_DELAY
         warned = False
+        from EdgeGPT.EdgeGPT import ConversationStyle
+
+        metrics.BING_STREAMS.inc()
+        stream = tracing.begin("ask_stream", cookie=cookie)
         try:
-            async for final, resp in ut.CONV["all"][self.cid][self.conv_id][
+            async for final, resp in ut.CONV["all"][self.chat][self.conv_id][
                 0
             ].ask_stream(
                 prompt=self.text,
@@ -269,13 +620,13 @@ class BingAI:
                 ),
             ):
                 current = time.time()
+                if first is None:
+                    first = current
+                    metrics.BING_FIRST.observe(first - start, cookie=cookie)
+                if recorder.enabled() and not final:
+                    chunks.append((round(current - begin, 3), len(resp)))
                 if current - start > delay and not final:
-                    resp = JSON_RESP.sub("", resp)
-                    resp = SRCH_RESP.sub("", resp)
-                    resp = GEN_RESP.sub("\\1", resp)
-                    resp = REF_INLINE_ST.sub("", resp)
-                    resp = REF_ST.sub("", resp)
-                    resp = resp.strip()
+                    resp = clean_stream(resp)
                     if resp:
                         text = (
                             f"<b>You</b>: {html.escape(self.text)}\n\n"
@@ -313,13 +664,31 @@ class BingAI:
                 if final:
                     self._response = resp
         except Exception as e:
+            tracing.fail(stream, e)
+            metrics.BING_ANSWERS.inc(cookie=cookie, result="exception")
             await ut.send(self.update, e.args[0])
             ut.delete_job(self.context, job_name)
             return
+        finally:
+            metrics.BING_STREAMS.dec()
+            tracing.end(stream, edits=edits)
+        elapsed = time.time() - begin
+        metrics.BING_ANSWER.observe(elapsed, cookie=cookie)
+        metrics.ANSWERS_HOUR.observe(elapsed, cookie=cookie)
+        metrics.BING_EDITS.observe(edits)
         if not self.inline:
-            ut.RUN[self.cid][self.conv_id].remove(turn)
+            ut.RUN[self.chat][self.conv_id].remove(turn)
             ut.delete_job(self.context, job_name)
         item = self._response["item"]
+        tracing.annotate(conv=self.conv_id, result=item["result"]["value"])
+        if recorder.enabled():
+            recorder.stream(
+                self.cid,
+                chunks,
+                item["result"]["value"],
+                sum(len(msg.get("text", "")) for msg in item["messages"]),
+            )
+        metrics.BING_ANSWERS.inc(cookie=cookie, result=item["result"]["value"])
         if item["result"]["value"] == "Success":
             self.user_msg = item["throttling"]["numUserMessagesInConversation"]
             self.user_msg_max = item["throttling"][
@@ -367,6 +736,7 @@ class BingAI:
             f"<code>Conversation ID: {self.conv_id}</code>\n"
         )
 
+    @tracing.traced("parse_message")
     async def parse_message(self, message: Dict[str, Any]) -> None:
         self.message_md = message["text"]
         text = markdown_to_html(self.message_md)
@@ -451,7 +821,13 @@ class BingAI:
                 )
 
         if tts and not self.inline:
-            await send_tts_audio(message["text"])
+            await send_tts_audio(
+                self.update,
+                self.context,
+                message["text"],
+                self.conv_id,
+                self.user_msg,
+            )
 
         if (
             "adaptiveCards" in message
@@ -461,11 +837,10 @@ class BingAI:
             images = IMG_RESP.findall(raw)
             if images:
                 if not self.inline:
-                    media = [InputMediaPhoto(img) for img in images]
-                    await self.update.effective_message.reply_media_group(
-                        media,
-                        caption=f"<b>You</b>: {self.text}",
-                        parse_mode=ParseMode.HTML,
+                    await reply_images(
+                        self.update.effective_message,
+                        images,
+                        f"<b>You</b>: {self.text}",
                     )
                 else:
                     await asyncio.sleep(2)
@@ -6,18 +6,24 @@
 # This work is licensed under the terms of the MIT license.
 
 import asyncio
+import copy
+import io
 import json
 import logging
 import os
 import sys
+import time
+from functools import partial
+from typing import Dict, List, Tuple
 from uuid import uuid4
 
 import backend
 
 import database as db
+import metrics
+import profiler
+import tracing
 import utils as ut
-from EdgeGPT.EdgeGPT import ConversationStyle
-from EdgeGPT.ImageGen import ImageGenAsync
 
 from telegram import (
     constants,
@@ -41,6 +47,9 @@ HELP = [
     ("history_update", "Force chat history update"),
     ("get", "Retrieve configuration files"),
     ("update", "Update configuration files"),
+    ("stats", "Show load and resource usage"),
+    ("profile", "Profile the bot for some seconds, e.g. /profile 30 mem"),
+    ("reload", "Reload configuration and cookies without restarting"),
     ("reset", "Restart bot"),
     ("cancel", "Cancel current update action"),
     ("help", "List of commands"),
@@ -57,9 +66,9 @@ async def unlock(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if (
         context.args
         and ut.passwd_correct(context.args[0])
-        and not db.cached(cid)
+        and not ut.unlocked(cid)
     ):
-        db.add_user(cid)
+        ut.unlock(cid)
         await ut.send(
             update, "Bot unlocked. Start a conversation with /new_conversation"
         )
@@ -70,7 +79,7 @@ async def new_conversation(
 ) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         await ut.is_active_conversation(update, new=True)
 
 
@@ -79,12 +88,13 @@ async def switch_conversation(
 ) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         resp = ut.send
         if callback:
             resp = ut.edit
-        if cid in ut.CONV["all"]:
-            cur_conv = ut.CONV["current"][cid]
+        chat = ut.conv_key(update)
+        if chat in ut.CONV["all"]:
+            cur_conv = ut.CONV["current"][chat]
             btn_lst = [
                 ut.button(
                     [
@@ -94,12 +104,12 @@ async def switch_conversation(
                         )
                     ]
                 )
-                for conv in sorted(ut.CONV["all"][cid].keys())
+                for conv in sorted(ut.CONV["all"][chat].keys())
             ]
             msg = (
                 f"Your current conversation is <b>{cur_conv}</b>\n\n"
                 f"<b>Last conversation prompt</b>: "
-                f"<code>{ut.CONV['all'][cid][cur_conv][1]}</code>"
+                f"<code>{ut.CONV['all'][chat][cur_conv][1]}</code>"
                 if cur_conv
                 else "You don't have an active conversation"
             )
@@ -118,14 +128,15 @@ async def delete_conversation(
 ) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         resp = ut.send
         if callback:
             resp = ut.edit
-        if cid in ut.CONV["all"] and ut.CONV["all"][cid]:
+        chat = ut.conv_key(update)
+        if chat in ut.CONV["all"] and ut.CONV["all"][chat]:
             btn_lst = [
                 ut.button([(conv, f"conv_delete_{conv}")])
-                for conv in sorted(ut.CONV["all"][cid].keys())
+                for conv in sorted(ut.CONV["all"][chat].keys())
             ]
             msg = (
                 "List of conversations.\n\nChoose conversation to delete"
@@ -149,12 +160,13 @@ async def export_conversation(
 ) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         resp = ut.send
-        if cid in ut.CONV["all"] and ut.CONV["all"][cid]:
+        chat = ut.conv_key(update)
+        if chat in ut.CONV["all"] and ut.CONV["all"][chat]:
             btn_lst = [
                 ut.button([(conv, f"conv_export_bt_{conv}")])
-                for conv in sorted(ut.CONV["all"][cid].keys())
+                for conv in sorted(ut.CONV["all"][chat].keys())
             ]
             msg = (
                 "List of conversations.\n\nChoose conversation to export"
@@ -176,10 +188,11 @@ async def export(
 ) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         msg = "You don't have an active conversation"
-        if cid in ut.CONV["all"] and conv_id in ut.CONV["all"][cid]:
-            hist = await ut.CONV["all"][cid][conv_id][0].get_conversation()
+        chat = ut.conv_key(update)
+        if chat in ut.CONV["all"] and conv_id in ut.CONV["all"][chat]:
+            hist = await ut.CONV["all"][chat][conv_id][0].get_conversation()
             if "messages" in hist:
                 relevant = [
                     (msg["author"], msg["text"])
@@ -212,9 +225,9 @@ async def help_usage(
 ) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         help_fmt = [f"- /{cmd[0]} - {cmd[1]}" for cmd in HELP]
-        if cid in ut.chats("admin"):
+        if ut.is_admin(cid):
             help_fmt.append("\nHidden commands:\n")
             for cmd in HIDDEN:
                 text = f"- /{cmd[0]} - {cmd[1]}"
@@ -236,7 +249,7 @@ async def history_update(
     context: ContextTypes.DEFAULT_TYPE,
 ) -> None:
     cid = ut.cid(update)
-    if cid in ut.chats("admin"):
+    if ut.is_admin(cid):
         await ut.send(update, "Updating chat history...")
         await ut.retrieve_history()
     else:
@@ -248,100 +261,258 @@ async def reset_bot(
     context: ContextTypes.DEFAULT_TYPE,
 ) -> None:
     cid = ut.cid(update)
-    if cid in ut.chats("admin"):
+    if ut.is_admin(cid):
         await ut.send(update, "Restarting bot...")
         os.execv(sys.argv[0], sys.argv)
     else:
         await ut.no_permissions(update)
 
 
+async def reload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    cid = ut.cid(update)
+    if ut.is_admin(cid):
+        try:
+            changed = ut.reload_config()
+        except (OSError, KeyError, json.decoder.JSONDecodeError) as e:
+            await ut.send(update, f"Reload failed: {e}")
+        else:
+            await ut.send(
+                update,
+                f"Configuration reloaded. "
+                f"Changed cookies: {', '.join(changed) or 'none'}",
+            )
+            if changed:
+                asyncio.create_task(ut.recycle_conversations(update, changed))
+    else:
+        await ut.no_permissions(update)
+
+
+def stats_text() -> str:
+    convs = sum(len(chat) for chat in ut.CONV["all"].values())
+    turns = [turns for chat in ut.RUN.values() for turns in chat.values()]
+    running = sum(1 for trn in turns if trn)
+    queued = sum(len(trn) - 1 for trn in turns if trn)
+    answers = metrics.ANSWERS_HOUR
+    lines = [
+        f"<b>Conversations</b>: {convs} in {len(ut.CONV['all'])} chats",
+        f"<b>Turns</b>: {running} running, {queued} queued",
+        f"<b>Bing streams</b>: {metrics.BING_STREAMS.value():.0f}",
+        f"<b>Answers (last hour)</b>: {answers.count()}, "
+        f"p50 ≤ {answers.quantile(0.5)}s, p95 ≤ {answers.quantile(0.95)}s",
+        "<b>Cookies (last hour)</b>:",
+    ]
+    now = time.monotonic()
+    rate = backend.image_rate()
+    cookies = set(ut.DATA["cookies"]["all"]) | {
+        dict(key)["cookie"] for key in answers.values
+    }
+    for cookie in sorted(cookies):
+        images = sum(
+            1
+            for used in backend.IMAGE_USAGE.get(cookie, [])
+            if used > now - backend.IMAGE_WINDOW
+        )
+        lines.append(
+            f"- {cookie}: {answers.count(cookie=cookie)} answers, "
+            f"{images}/{rate} images"
+        )
+    queue = backend.IMAGE_POOL["queue"]
+    lines.append(
+        f"<b>Image queue</b>: {queue.qsize() if queue else 0} waiting, "
+        f"{backend.IMAGE_POOL['busy']}/{len(backend.IMAGE_POOL['workers'])} "
+        f"workers busy"
+    )
+    caches = {}
+    for key, value in metrics.CACHE.values.items():
+        labels = dict(key)
+        caches.setdefault(labels["cache"], {})[labels["result"]] = value
+    lines.append("<b>Cache hit rate</b>:")
+    for cache, results in sorted(caches.items()):
+        total = sum(results.values())
+        hits = results.get("hit", 0) + results.get("shared", 0)
+        lines.append(f"- {cache}: {hits / total:.0%} ({hits:.0f}/{total:.0f})")
+    connections = {}
+    for key, value in metrics.HTTP_CONNECTIONS.values.items():
+        labels = dict(key)
+        connections.setdefault(labels["session"], {})[labels["result"]] = value
+    lines.append("<b>HTTP connections (new/reused)</b>:")
+    for session, results in sorted(connections.items()):
+        lines.append(
+            f"- {session}: {results.get('new', 0):.0f}/"
+            f"{results.get('reused', 0):.0f}"
+        )
+    lines.append(f"<b>Memory</b>: {ut.rss() / 2**20:.1f} MiB RSS")
+    return "\n".join(lines)
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    cid = ut.cid(update)
+    if ut.is_admin(cid):
+        await ut.send(update, stats_text())
+    else:
+        await ut.no_permissions(update)
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    cid = ut.cid(update)
+    if ut.is_admin(cid):
+        seconds = 30
+        if context.args and context.args[0].isdigit():
+            seconds = max(1, min(int(context.args[0]), profiler.PROFILE_MAX))
+        memory = "mem" in context.args
+        if profiler.PROFILE["running"]:
+            await ut.send(update, "There is a profile already running")
+        else:
+            profiler.PROFILE["running"] = True
+            try:
+                await ut.send(update, f"Profiling for {seconds} seconds...")
+                stacks, allocations = await profiler.profile(seconds, memory)
+            finally:
+                profiler.PROFILE["running"] = False
+            if stacks:
+                await update.effective_message.reply_document(
+                    io.BytesIO(stacks.encode()),
+                    filename="profile.collapsed",
+                    caption=(
+                        "Collapsed stacks, open them with speedscope.app "
+                        "or flamegraph.pl"
+                    ),
+                )
+            else:
+                await ut.send(update, "No stacks were sampled")
+            if allocations:
+                await update.effective_message.reply_document(
+                    io.BytesIO(allocations.encode()),
+                    filename="allocations.txt",
+                )
+    else:
+        await ut.no_permissions(update)
+
+
 async def cancel(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
 ) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         if cid in ut.STATE:
             del ut.STATE[cid]
             await ut.send(update, "Current action cancelled")
 
 
+def settings_buttons(admin: bool) -> List[List[Tuple[str, str]]]:
+    btn_lst = [
+        [("Languages/Voices", "langs_menu")],
+        [("Conversation styles", "styles_menu")],
+        [("Toggle TTS", "tts_menu")],
+        [("Backends", "backends_menu")],
+    ]
+    if admin:
+        btn_lst.append([("Cookies", "cookies_menu")])
+    return btn_lst
+
+
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid):
-        btn_lst = [
-            ut.button([("Languages/Voices", "langs_menu")]),
-            ut.button([("Conversation styles", "styles_menu")]),
-            ut.button([("Toggle TTS", "tts_menu")]),
-            ut.button([("Backends", "backends_menu")]),
-        ]
-        if cid in ut.chats("admin"):
-            btn_lst.append(ut.button([("Cookies", "cookies_menu")]))
+    if ut.unlocked(cid):
+        admin = ut.is_admin(cid)
         resp = ut.send
         if update.callback_query is not None:
             resp = ut.edit
         await resp(
             update,
             "Bot settings",
-            reply_markup=ut.markup(btn_lst),
+            reply_markup=ut.keyboard(
+                ("settings", admin), partial(settings_buttons, admin)
+            ),
         )
 
 
+def langs_buttons(
+    voices: Dict[str, Dict[str, List[str]]]
+) -> List[List[Tuple[str, str]]]:
+    btn_lst = [
+        [(lang.upper(), f"genders_menu_{lang}") for lang in chunk]
+        for chunk in ut.chunk(sorted(voices))
+    ]
+    btn_lst.append([("« Back to Settings", "settings_menu")])
+    return btn_lst
+
+
 async def langs_menu(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         voices = await ut.list_voices()
         cur_voice = db.voice(cid)
-        btn_lst = [
-            ut.button(
-                [(lang.upper(), f"genders_menu_{lang}") for lang in chunk]
-            )
-            for chunk in ut.chunk(sorted(voices))
-        ]
-        btn_lst.append(ut.button([("« Back to Settings", "settings_menu")]))
         resp = ut.send
         if update.callback_query is not None:
             resp = ut.edit
         await resp(
             update,
             f"Your current voice is <b>{cur_voice}</b>\n\nLanguages list:",
-            reply_markup=ut.markup(btn_lst),
+            reply_markup=ut.keyboard(
+                ("langs",), partial(langs_buttons, voices)
+            ),
         )
 
 
+def genders_buttons(
+    voices: Dict[str, Dict[str, List[str]]], language: str
+) -> List[List[Tuple[str, str]]]:
+    btn_lst = [
+        [(gend, f"voices_menu_{language}_{gend}")]
+        for gend in sorted(voices[language])
+    ]
+    btn_lst.append(
+        [
+            ("« Back to Languages", "langs_menu"),
+            ("« Back to Settings", "settings_menu"),
+        ]
+    )
+    return btn_lst
+
+
 async def genders_menu(
     update: Update, context: ContextTypes.DEFAULT_TYPE, language: str
 ) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         voices = await ut.list_voices()
         cur_voice = db.voice(cid)
-        btn_lst = [
-            ut.button([(gend, f"voices_menu_{language}_{gend}")])
-            for gend in sorted(voices[language])
-        ]
-        btn_lst.append(
-            ut.button(
-                [
-                    ("« Back to Languages", "langs_menu"),
-                    ("« Back to Settings", "settings_menu"),
-                ]
-            )
-        )
         resp = ut.send
         if update.callback_query is not None:
             resp = ut.edit
         await resp(
             update,
             f"Your current voice is <b>{cur_voice}</b>\n\nGenders list:",
-            reply_markup=ut.markup(btn_lst),
+            reply_markup=ut.keyboard(
+                ("genders", language),
+                partial(genders_buttons, voices, language),
+            ),
         )
 
 
+def voices_buttons(
+    voices: Dict[str, Dict[str, List[str]]], language: str, gender: str
+) -> List[List[Tuple[str, str]]]:
+    btn_lst = [
+        [(_voice, f"voice_set_{language}_{gender}_{_voice}")]
+        for _voice in sorted(voices[language][gender])
+    ]
+    btn_lst.append(
+        [
+            ("« Back to Genders", f"genders_menu_{language}"),
+            ("« Back to Languages", "langs_menu"),
+            ("« Back to Settings", "settings_menu"),
+        ]
+    )
+    return btn_lst
+
+
 async def voices_menu(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -349,61 +520,40 @@ async def voices_menu(
     gender: str,
 ) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         voices = await ut.list_voices()
         cur_voice = db.voice(cid)
-        btn_lst = [
-            ut.button(
-                [
-                    (
-                        _voice if _voice != cur_voice else f"» {_voice} «",
-                        f"voice_set_{language}_{gender}_{_voice}",
-                    )
-                ]
-            )
-            for _voice in sorted(voices[language][gender])
-        ]
-        btn_lst.append(
-            ut.button(
-                [
-                    ("« Back to Genders", f"genders_menu_{language}"),
-                    ("« Back to Languages", "langs_menu"),
-                    ("« Back to Settings", "settings_menu"),
-                ]
-            )
-        )
         resp = ut.send
         if update.callback_query is not None:
             resp = ut.edit
         await resp(
             update,
             f"Your current voice is <b>{cur_voice}</b>\n\nVoices list:",
-            reply_markup=ut.markup(btn_lst),
+            reply_markup=ut.keyboard(
+                ("voices", language, gender),
+                partial(voices_buttons, voices, language, gender),
+                f"voice_set_{language}_{gender}_{cur_voice}",
+            ),
         )
 
 
+def styles_buttons() -> List[List[Tuple[str, str]]]:
+    from EdgeGPT.EdgeGPT import ConversationStyle
+
+    btn_lst = [
+        [(st.name.capitalize(), f"style_set_{st.name}")]
+        for st in ConversationStyle
+    ]
+    btn_lst.append([("« Back to Settings", "settings_menu")])
+    return btn_lst
+
+
 async def styles_menu(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         cur_style = db.style(cid)
-        btn_lst = [
-            ut.button(
-                [
-                    (
-                        (
-                            st.name.capitalize()
-                            if st.name != cur_style
-                            else f"» {st.name.capitalize()} «"
-                        ),
-                        f"style_set_{st.name}",
-                    )
-                ]
-            )
-            for st in ConversationStyle
-        ]
-        btn_lst.append(ut.button([("« Back to Settings", "settings_menu")]))
         resp = ut.send
         if update.callback_query is not None:
             resp = ut.edit
@@ -412,13 +562,15 @@ async def styles_menu(
             f"Your current conversation style is "
             f"<b>{cur_style.capitalize()}</b>\n\n"
             f"Conversation styles:",
-            reply_markup=ut.markup(btn_lst),
+            reply_markup=ut.keyboard(
+                ("styles",), styles_buttons, f"style_set_{cur_style}"
+            ),
         )
 
 
 async def tts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         cur_tts = db.tts(cid)
         state = "Yes" if cur_tts == 1 else "No"
         btn_lst = [
@@ -435,32 +587,50 @@ async def tts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
 
 
+def backends_buttons() -> List[List[Tuple[str, str]]]:
+    return [
+        # [("Chat", "backend_menu_chat")],
+        [("ASR", "backend_menu_asr")],
+        # [("Image", "backend_menu_image")],
+        [("« Back to Settings", "settings_menu")],
+    ]
+
+
 async def backends_menu(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
-        btn_lst = [
-            # ut.button([("Chat", "backend_menu_chat")]),
-            ut.button([("ASR", "backend_menu_asr")]),
-            # ut.button([("Image", "backend_menu_image")]),
-            ut.button([("« Back to Settings", "settings_menu")]),
-        ]
+    if ut.unlocked(cid):
         resp = ut.send
         if update.callback_query is not None:
             resp = ut.edit
         await resp(
             update,
             "Backends",
-            reply_markup=ut.markup(btn_lst),
+            reply_markup=ut.keyboard(("backends",), backends_buttons),
         )
 
 
+def backend_buttons(
+    backend_type: str, backends: List[str]
+) -> List[List[Tuple[str, str]]]:
+    btn_lst = [
+        [(back, f"backend_set_{backend_type}_{back}")] for back in backends
+    ]
+    btn_lst.append(
+        [
+            ("« Back to Backends", "backends_menu"),
+            ("« Back to Settings", "settings_menu"),
+        ]
+    )
+    return btn_lst
+
+
 async def backend_menu(
     update: Update, context: ContextTypes.DEFAULT_TYPE, backend_type: str
 ) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         if backend_type == "chat":
             cur_back = db.chat_backend(cid)
             backends = db.CHAT_BACKENDS
@@ -475,25 +645,6 @@ async def backend_menu(
             if backend_type != "asr"
             else backend_type.upper()
         )
-        btn_lst = [
-            ut.button(
-                [
-                    (
-                        back if back != cur_back else f"» {back} «",
-                        f"backend_set_{backend_type}_{back}",
-                    )
-                ]
-            )
-            for back in backends
-        ]
-        btn_lst.append(
-            ut.button(
-                [
-                    ("« Back to Backends", "backends_menu"),
-                    ("« Back to Settings", "settings_menu"),
-                ]
-            )
-        )
         resp = ut.send
         if update.callback_query is not None:
             resp = ut.edit
@@ -501,7 +652,11 @@ async def backend_menu(
             update,
             f"Your current {btype} backend is <b>{cur_back}</b>\n\n"
             f"{btype} backends:",
-            reply_markup=ut.markup(btn_lst),
+            reply_markup=ut.keyboard(
+                ("backend", backend_type),
+                partial(backend_buttons, backend_type, backends),
+                f"backend_set_{backend_type}_{cur_back}",
+            ),
         )
 
 
@@ -509,7 +664,7 @@ async def cookies_menu(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     cid = ut.cid(update)
-    if cid in ut.chats("admin"):
+    if ut.is_admin(cid):
         btn_lst = [
             ut.button(
                 [
@@ -549,7 +704,7 @@ async def tts(
     msg_idx: str,
 ) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         if cid in ut.DATA["msg"] and conv_id in ut.DATA["msg"][cid]:
             await backend.send_tts_audio(
                 update, context, ut.DATA["msg"][cid][conv_id], conv_id, msg_idx
@@ -561,32 +716,49 @@ async def tts(
         await ut.remove_button(update, f"tts_send_{conv_id}_{msg_idx}")
 
 
+@tracing.traced("voice", root=True)
 async def voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid) and (ut.is_reply(update) or not ut.is_group(update)):
-        status = await ut.is_active_conversation(update)
+    if ut.unlocked(cid) and (ut.is_reply(update) or not ut.is_group(update)):
+        tracing.annotate(chat=cid)
+        with tracing.span("is_active_conversation"):
+            status = await ut.is_active_conversation(update)
         if status:
-            voice_file = await update.message.voice.get_file()
-            data = await voice_file.download_as_bytearray()
-            action = constants.ChatAction.RECORD_VOICE
-            job_name = ut.action_schedule(update, context, action)
-            transcription = await backend.automatic_speech_recognition(
-                cid, voice_file.file_id, data
+            uid = update.message.voice.file_unique_id
+            transcription = db.transcript(uid)
+            metrics.CACHE.inc(
+                cache="transcript",
+                result="miss" if transcription is None else "hit",
             )
-            ut.delete_job(context, job_name)
+            if transcription is None:
+                voice_file = await update.message.voice.get_file()
+                action = constants.ChatAction.RECORD_VOICE
+                job_name = ut.action_schedule(update, context, action)
+                transcription = await backend.automatic_speech_recognition(
+                    cid,
+                    voice_file.file_id,
+                    backend.download_stream(voice_file),
+                    update.message.voice.duration,
+                )
+                ut.delete_job(context, job_name)
+                if transcription not in (None, backend.ASR_ERROR):
+                    db.add_transcript(uid, transcription)
             if transcription is not None:
                 query = backend.BingAI(update, context, transcription)
                 asyncio.create_task(query.run())
 
 
+@tracing.traced("message", root=True)
 async def message(
     update: Update, context: ContextTypes.DEFAULT_TYPE, text: str = None
 ) -> None:
     cid = ut.cid(update)
     ut.add_whitelisted(cid)
-    if db.cached(cid) and (ut.is_reply(update) or not ut.is_group(update)):
-        status = await ut.is_active_conversation(update)
+    if ut.unlocked(cid) and (ut.is_reply(update) or not ut.is_group(update)):
+        tracing.annotate(chat=cid)
+        with tracing.span("is_active_conversation"):
+            status = await ut.is_active_conversation(update)
         if status:
             callback = None
             if text is not None:
@@ -598,7 +770,7 @@ async def message(
 
 async def get_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     cid = ut.cid(update)
-    if cid in ut.chats("admin"):
+    if ut.is_admin(cid):
         if context.args and context.args[0] in ("config", "cookies"):
             if context.args[0] == "cookies":
                 _path = ut.Path(ut.PATH["dir"]).joinpath(
@@ -622,7 +794,7 @@ async def update_file(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     cid = ut.cid(update)
-    if cid in ut.chats("admin"):
+    if ut.is_admin(cid):
         if context.args and context.args[0] in ("config", "cookies"):
             ut.STATE[cid] = context.args[0]
             await ut.send(update, "Ok, send me JSON file")
@@ -651,40 +823,33 @@ async def process_file(
             if ut.STATE[cid] == "cookies":
                 curr = ut.DATA["cookies"]["current"]
                 _path = ut.Path(ut.PATH["dir"]).joinpath(f"{curr}.json")
-                ut.DATA["cookies"]["all"][curr] = correct
-                for ck in correct:
-                    if ck["name"] == "_U":
-                        ut.DATA["cookies"]["_U"][curr] = ck["value"]
-                        break
             else:
                 _path = ut.path(ut.STATE[cid])
+            try:
+                if ut.STATE[cid] == "config":
+                    changed = ut.apply_config(copy.deepcopy(correct))
+                else:
+                    changed = ut.apply_cookies(
+                        {**ut.DATA["cookies"]["all"], curr: correct}
+                    )
+            except (OSError, KeyError, json.decoder.JSONDecodeError) as e:
+                await ut.send(update, f"Update failed: {e}", quote=True)
+                return
             with _path.open("w") as f:
                 json.dump(correct, f, indent=2)
-            if ut.STATE[cid] == "config":
-                ut.DATA["config"] = correct
-            else:
-                for _cid, convs in ut.CONV["all"].items():
-                    to_del = []
-                    for conv_id, (conv, _) in convs.items():
-                        await conv.close()
-                        to_del.append(conv_id)
-                    for conv_id in to_del:
-                        if conv_id in ut.CONV["all"][cid]:
-                            del ut.CONV["all"][cid][conv_id]
-                    status = await ut.create_conversation(update, _cid)
-                    if not status:
-                        break
             await ut.send(
                 update,
                 f"File {ut.STATE[cid]}.json updated successfully",
                 quote=True,
             )
             del ut.STATE[cid]
+            if changed:
+                asyncio.create_task(ut.recycle_conversations(update, changed))
 
 
 async def image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         if context.args:
             await send_media(update, context, " ".join(context.args))
         else:
@@ -696,6 +861,24 @@ async def image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             )
 
 
+async def queued(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    prompt: str,
+    inline: bool,
+    position: int,
+) -> None:
+    msg = f"Image generation queued. Position: {position}"
+    if not inline:
+        await ut.send(update, msg, quote=True)
+    else:
+        await context.bot.edit_message_caption(
+            inline_message_id=update.chosen_inline_result.inline_message_id,
+            caption=f"<b>You</b>: {prompt}\n\n<code>{msg}</code>",
+            parse_mode=ParseMode.HTML,
+        )
+
+
 async def send_media(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -707,57 +890,52 @@ async def send_media(
         job_name = ut.action_schedule(update, context, action)
     msg = "Cookies required to use this functionality."
     if ut.DATA["cookies"]["all"]:
-        curr = ut.DATA["cookies"]["current"]
         msg = "Invalid cookies"
-        if curr in ut.DATA["cookies"]["_U"]:
-            async with ImageGenAsync(
-                ut.DATA["cookies"]["_U"][curr], quiet=True
-            ) as iga:
-                try:
-                    images = await iga.get_images(prompt)
-                except Exception as e:  # noqa
-                    msg = e.args[0]
-                    logging.getLogger("BingImageCreator").error(msg)
+        if ut.DATA["cookies"]["_U"]:
+            try:
+                images = await backend.generate_images(
+                    prompt, partial(queued, update, context, prompt, inline)
+                )
+            except Exception as e:  # noqa
+                msg = e.args[0]
+                logging.getLogger("BingImageCreator").error(msg)
+            else:
+                if not inline:
+                    messages = await backend.reply_images(
+                        update.effective_message,
+                        backend.uploaded_images(
+                            prompt, images, context.bot.id
+                        ),
+                        f"<b>You</b>: {prompt}",
+                    )
+                    backend.cache_images(prompt, messages)
                 else:
-                    if not inline:
-                        media = [InputMediaPhoto(img) for img in images]
-                        await update.effective_message.reply_media_group(
-                            media,
+                    _cid = update.chosen_inline_result.inline_message_id
+                    uuid = update.chosen_inline_result.result_id
+                    owner = update.chosen_inline_result.from_user.id
+                    ut.MEDIA.set((_cid, uuid), (prompt, images))
+                    await context.bot.edit_message_media(
+                        InputMediaPhoto(
+                            images[0],
                             caption=f"<b>You</b>: {prompt}",
                             parse_mode=ParseMode.HTML,
-                        )
-                    else:
-                        media = [
-                            InputMediaPhoto(
-                                img,
-                                caption=f"<b>You</b>: {prompt}",
-                                parse_mode=ParseMode.HTML,
-                            )
-                            for img in images
-                        ]
-                        _cid = update.chosen_inline_result.inline_message_id
-                        uuid = update.chosen_inline_result.result_id
-                        if _cid not in ut.MEDIA:
-                            ut.MEDIA[_cid] = {}
-                        ut.MEDIA[_cid][uuid] = (prompt, media)
-                        await context.bot.edit_message_media(
-                            media[0],
-                            inline_message_id=_cid,
-                            reply_markup=ut.markup(
-                                [
-                                    ut.button(
-                                        [
-                                            ("<", f"inline_0_{uuid}_-1"),
-                                            (">", f"inline_0_{uuid}_1"),
-                                        ]
-                                    )
-                                ]
-                            ),
-                        )
-                    return
-                finally:
-                    if not inline:
-                        ut.delete_job(context, job_name)
+                        ),
+                        inline_message_id=_cid,
+                        reply_markup=ut.markup(
+                            [
+                                ut.button(
+                                    [
+                                        ("<", f"inline_0_{uuid}_-1_{owner}"),
+                                        (">", f"inline_0_{uuid}_1_{owner}"),
+                                    ]
+                                )
+                            ]
+                        ),
+                    )
+                return
+            finally:
+                if not inline:
+                    ut.delete_job(context, job_name)
     if not inline:
         await ut.send(
             update,
@@ -819,13 +997,14 @@ async def inline_message(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         _args = update.chosen_inline_result.query.split()
         _cmd = _args[0]
         _text = " ".join(_args[1:])
         if _cmd == "query":
-            ut.init_chat(cid)
-            status = await ut.create_conversation(update, cid)
+            chat = ut.conv_key(update)
+            ut.init_chat(chat)
+            status = await ut.create_conversation(update, chat)
             if status:
                 query = backend.BingAI(update, context, _text, inline=True)
                 asyncio.create_task(query.run())
@@ -839,24 +1018,35 @@ async def switch_inline_image(
     index: int,
     uuid: str,
     direction: int,
+    owner: int,
 ) -> None:
     _cid = update.callback_query.inline_message_id
-    if _cid not in ut.MEDIA or uuid not in ut.MEDIA[_cid]:
+    carousel = ut.MEDIA.get((_cid, uuid))
+    metrics.CACHE.inc(
+        cache="media", result="miss" if carousel is None else "hit"
+    )
+    if carousel is None:
         await context.bot.edit_message_reply_markup(
             inline_message_id=_cid,
             reply_markup=None,
         )
     else:
-        new_idx = (index + direction) % len(ut.MEDIA[_cid][uuid][1])
+        prompt, images = carousel
+        images = backend.uploaded_images(prompt, images, context.bot.id)
+        new_idx = (index + direction) % len(images)
         await context.bot.edit_message_media(
-            ut.MEDIA[_cid][uuid][1][new_idx],
+            InputMediaPhoto(
+                images[new_idx],
+                caption=f"<b>You</b>: {prompt}",
+                parse_mode=ParseMode.HTML,
+            ),
             inline_message_id=_cid,
             reply_markup=ut.markup(
                 [
                     ut.button(
                         [
-                            ("<", f"inline_{new_idx}_{uuid}_-1"),
-                            (">", f"inline_{new_idx}_{uuid}_1"),
+                            ("<", f"inline_{new_idx}_{uuid}_-1_{owner}"),
+                            (">", f"inline_{new_idx}_{uuid}_1_{owner}"),
                         ]
                     )
                 ]
@@ -6,15 +6,19 @@
 # This work is licensed under the terms of the MIT license.
 
 import sqlite3 as sql
+import time
 
 from contextlib import closing
+from typing import List, Tuple
 
 import utils as ut
 
 
 CHAT_BACKENDS = ["bing", "chatgpt", "chatgpt4"]
-ASR_BACKENDS = ["whisper", "assemblyai"]
+ASR_BACKENDS = ["whisper", "assemblyai", "local"]
 IMAGE_BACKENDS = ["bing", "dall-e"]
+TRANSCRIPT_LIMIT = 1000
+DEFAULT_VOICE = "en-US-AnaNeural"
 
 
 def setup_db() -> None:
@@ -31,6 +35,18 @@ def setup_db() -> None:
                     asr_backend TEXT DEFAULT 'whisper',
                     image_backend TEXT DEFAULT 'bing'
                 );
+
+                CREATE TABLE IF NOT EXISTS voices (
+                    name TEXT PRIMARY KEY,
+                    lang TEXT,
+                    gender TEXT
+                );
+
+                CREATE TABLE IF NOT EXISTS transcripts (
+                    uid TEXT PRIMARY KEY,
+                    text TEXT,
+                    last_used REAL
+                );
                 """
             )
 
@@ -71,6 +87,13 @@ def cached(cid: int) -> int:
             return cur.fetchone()[0]
 
 
+def users() -> List[int]:
+    with closing(sql.connect(ut.path("database"))) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute("SELECT cid FROM users")
+            return [row[0] for row in cur.fetchall()]
+
+
 def add_user(cid: int) -> None:
     with closing(sql.connect(ut.path("database"))) as db:
         with closing(db.cursor()) as cur:
@@ -178,3 +201,60 @@ def set_image_backend(cid: int, backend: str) -> None:
                 [backend, cid],
             )
             db.commit()
+
+
+def transcript(uid: str) -> str:
+    with closing(sql.connect(ut.path("database"))) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute("SELECT text FROM transcripts WHERE uid = ?", [uid])
+            row = cur.fetchone()
+            if row is not None:
+                cur.execute(
+                    "UPDATE transcripts SET last_used = ? WHERE uid = ?",
+                    [time.time(), uid],
+                )
+                db.commit()
+                return row[0]
+
+
+def add_transcript(uid: str, text: str) -> None:
+    with closing(sql.connect(ut.path("database"))) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute(
+                "INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?)",
+                [uid, text, time.time()],
+            )
+            cur.execute(
+                "DELETE FROM transcripts WHERE uid NOT IN "
+                "(SELECT uid FROM transcripts "
+                "ORDER BY last_used DESC LIMIT ?)",
+                [TRANSCRIPT_LIMIT],
+            )
+            db.commit()
+
+
+def voices() -> List[Tuple[str, str, str]]:
+    with closing(sql.connect(ut.path("database"))) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute("SELECT name, lang, gender FROM voices")
+            return cur.fetchall()
+
+
+def set_voices(voices: List[Tuple[str, str, str]]) -> None:
+    with closing(sql.connect(ut.path("database"))) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute("DELETE FROM voices")
+            cur.executemany("INSERT INTO voices VALUES (?, ?, ?)", voices)
+            db.commit()
+
+
+def reset_invalid_voices() -> int:
+    with closing(sql.connect(ut.path("database"))) as db:
+        with closing(db.cursor()) as cur:
+            cur.execute(
+                "UPDATE users SET voice = ? "
+                "WHERE voice NOT IN (SELECT name FROM voices)",
+                [DEFAULT_VOICE],
+            )
+            db.commit()
+            return cur.rowcount
@@ -6,18 +6,28 @@
 # This work is licensed under the terms of the MIT license.
 
 import argparse
+import asyncio
 import json
 import logging
 import mimetypes
 import subprocess
+import sys
 from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple, Union
 
+import backend
 import cmds
 
 import database as db
+import metrics
+import recorder
+import sessions
+import shard
+import tracing
 import utils as ut
+import watchdog
 
-from telegram import Update
+from telegram import Bot, Update
 from telegram.error import TimedOut
 from telegram.ext import (
     Application,
@@ -29,107 +39,253 @@ from telegram.ext import (
     filters,
     InlineQueryHandler,
     MessageHandler,
+    TypeHandler,
 )
 
 LEGACY_VERSION = "v3.7.1"
 
 
+ROUTES = {}
+
+
+def route(prefix: str, *types: Callable) -> Callable:
+    def register(func: Callable) -> Callable:
+        ROUTES[prefix] = (func, types)
+        return func
+
+    return register
+
+
+def parse_callback(data: str) -> Union[Tuple[Callable, List[Any]], None]:
+    head, _, rest = data.partition("_")
+    second, _, tail = rest.partition("_")
+    handler = ROUTES.get(f"{head}_{second}")
+    if handler is None:
+        handler = ROUTES.get(head)
+        if handler is None:
+            return None
+        tail = rest
+    func, types = handler
+    if not types:
+        return func, []
+    args = tail.split("_", len(types) - 1)
+    return func, [tp(arg) for tp, arg in zip(types, args)]
+
+
+@route("conv_new")
+async def conv_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await cmds.new_conversation(update, context, callback=True)
+
+
+@route("conv_set", str)
+async def conv_set(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, conv_id: str
+) -> None:
+    chat = ut.conv_key(update)
+    if chat in ut.CONV["current"]:
+        ut.CONV["current"][chat] = conv_id
+    try:
+        await cmds.switch_conversation(update, context, callback=True)
+    except KeyError:
+        await ut.remove_button(update, f"conv_set_{conv_id}")
+
+
+@route("conv_delete", str)
+async def conv_delete(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, data: str
+) -> None:
+    chat = ut.conv_key(update)
+    bt, _, conv_id = data.rpartition("_")
+    if chat in ut.CONV["all"] and conv_id in ut.CONV["all"][chat]:
+        await ut.CONV["all"][chat][conv_id][0].delete_conversation()
+        await ut.CONV["all"][chat][conv_id][0].close()
+        del ut.CONV["all"][chat][conv_id]
+        ut.CONV["cookie"].pop(conv_id, None)
+        cur_conv = ut.CONV["current"][chat]
+        if conv_id == cur_conv:
+            ut.CONV["current"][chat] = ""
+    if bt:
+        await ut.remove_conv_buttons(update)
+    else:
+        await cmds.delete_conversation(update, context, callback=True)
+
+
+@route("conv_export", str)
+async def conv_export(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, data: str
+) -> None:
+    bt, _, conv_id = data.rpartition("_")
+    await cmds.export(update, context, conv_id)
+    if not bt:
+        await ut.remove_button(update, update.callback_query.data)
+
+
+@route("settings_menu")
+async def settings_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    await cmds.settings(update, context)
+
+
+@route("langs_menu")
+async def langs_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    await cmds.langs_menu(update, context)
+
+
+@route("genders_menu", str)
+async def genders_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, language: str
+) -> None:
+    await cmds.genders_menu(update, context, language)
+
+
+@route("voices_menu", str, str)
+async def voices_menu(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    language: str,
+    gender: str,
+) -> None:
+    await cmds.voices_menu(update, context, language, gender)
+
+
+@route("voice_set", str, str, str)
+async def voice_set(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    language: str,
+    gender: str,
+    voice: str,
+) -> None:
+    db.set_voice(ut.cid(update), voice)
+    await cmds.voices_menu(update, context, language, gender)
+
+
+@route("styles_menu")
+async def styles_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    await cmds.styles_menu(update, context)
+
+
+@route("style_set", str)
+async def style_set(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, style: str
+) -> None:
+    db.set_style(ut.cid(update), style)
+    await cmds.styles_menu(update, context)
+
+
+@route("response", str)
+async def response(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, index: str
+) -> None:
+    await cmds.message(update, context, index)
+
+
+@route("tts_send", str, str)
+async def tts_send(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    conv_id: str,
+    msg_idx: str,
+) -> None:
+    await cmds.tts(update, context, conv_id, msg_idx)
+
+
+@route("tts_menu")
+async def tts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await cmds.tts_menu(update, context)
+
+
+@route("tts_toggle")
+async def tts_toggle(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    db.toggle_tts(ut.cid(update))
+    await cmds.tts_menu(update, context)
+
+
+@route("backends_menu")
+async def backends_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    await cmds.backends_menu(update, context)
+
+
+@route("backend_menu", str)
+async def backend_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, backend_type: str
+) -> None:
+    await cmds.backend_menu(update, context, backend_type)
+
+
+@route("backend_set", str, str)
+async def backend_set(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    backend_type: str,
+    name: str,
+) -> None:
+    cid = ut.cid(update)
+    if backend_type == "chat":
+        db.set_chat_backend(cid, name)
+    elif backend_type == "asr":
+        db.set_asr_backend(cid, name)
+    else:
+        db.set_image_backend(cid, name)
+    await cmds.backend_menu(update, context, backend_type)
+
+
+@route("cookies_menu")
+async def cookies_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    await cmds.cookies_menu(update, context)
+
+
+@route("cookie_set", str)
+async def cookie_set(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, cookie: str
+) -> None:
+    ut.DATA["cookies"]["current"] = cookie
+    _path = ut.Path(ut.PATH["dir"]).joinpath("current_cookie")
+    with _path.open("w") as f:
+        f.write(ut.DATA["cookies"]["current"])
+    await cmds.cookies_menu(update, context)
+
+
+@route("inline", int, str, int, int)
+async def inline(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    index: int,
+    uuid: str,
+    direction: int,
+    owner: int = 0,
+) -> None:
+    await cmds.switch_inline_image(
+        update, context, index, uuid, direction, owner
+    )
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = ut.cid(update)
-    if db.cached(cid):
+    if ut.unlocked(cid):
         query = update.callback_query
         await query.answer()
-        if query.data == "conv_new":
-            await cmds.new_conversation(update, context, callback=True)
-        elif query.data.startswith("conv_set"):
-            args = query.data.split("_")
-            if cid in ut.CONV["current"]:
-                ut.CONV["current"][cid] = args[-1]
-            try:
-                await cmds.switch_conversation(update, context, callback=True)
-            except KeyError:
-                await ut.remove_button(update, f"conv_set_{args[-1]}")
-        elif query.data.startswith("conv_delete"):
-            args = query.data.split("_")
-            conv_id = args[-1]
-            if cid in ut.CONV["all"] and conv_id in ut.CONV["all"][cid]:
-                await ut.CONV["all"][cid][conv_id][0].delete_conversation()
-                await ut.CONV["all"][cid][conv_id][0].close()
-                del ut.CONV["all"][cid][conv_id]
-                cur_conv = ut.CONV["current"][cid]
-                if conv_id == cur_conv:
-                    ut.CONV["current"][cid] = ""
-            if len(args) > 3:
-                await ut.remove_conv_buttons(update)
-            else:
-                await cmds.delete_conversation(update, context, callback=True)
-        elif query.data.startswith("conv_export"):
-            args = query.data.split("_")
-            await cmds.export(update, context, args[-1])
-            if args[-2] != "bt":
-                await ut.remove_button(update, query.data)
-        elif query.data == "settings_menu":
-            await cmds.settings(update, context)
-        elif query.data == "langs_menu":
-            await cmds.langs_menu(update, context)
-        elif query.data.startswith("genders_menu"):
-            args = query.data.split("_")
-            await cmds.genders_menu(update, context, args[-1])
-        elif query.data.startswith("voices_menu"):
-            args = query.data.split("_")
-            await cmds.voices_menu(update, context, args[-2], args[-1])
-        elif query.data.startswith("voice_set"):
-            args = query.data.split("_")
-            db.set_voice(cid, args[-1])
-            await cmds.voices_menu(update, context, args[-3], args[-2])
-        elif query.data == "styles_menu":
-            await cmds.styles_menu(update, context)
-        elif query.data.startswith("style_set"):
-            args = query.data.split("_")
-            db.set_style(cid, args[-1])
-            await cmds.styles_menu(update, context)
-        elif query.data.startswith("response"):
-            args = query.data.split("_")
-            await cmds.message(update, context, args[-1])
-        elif query.data.startswith("tts_send"):
-            args = query.data.split("_")
-            await cmds.tts(update, context, args[-2], args[-1])
-        elif query.data == "tts_menu":
-            await cmds.tts_menu(update, context)
-        elif query.data == "tts_toggle":
-            db.toggle_tts(cid)
-            await cmds.tts_menu(update, context)
-        elif query.data == "backends_menu":
-            await cmds.backends_menu(update, context)
-        elif query.data.startswith("backend_menu"):
-            args = query.data.split("_")
-            await cmds.backend_menu(update, context, args[-1])
-        elif query.data.startswith("backend_set"):
-            args = query.data.split("_")
-            if args[-2] == "chat":
-                db.set_chat_backend(cid, args[-1])
-            elif args[-2] == "asr":
-                db.set_asr_backend(cid, args[-1])
-            else:
-                db.set_image_backend(cid, args[-1])
-            await cmds.backend_menu(update, context, args[-2])
-        elif query.data == "cookies_menu":
-            await cmds.cookies_menu(update, context)
-        elif query.data.startswith("cookie_set"):
-            args = query.data.split("_")
-            ut.DATA["cookies"]["current"] = args[-1]
-            _path = ut.Path(ut.PATH["dir"]).joinpath("current_cookie")
-            with _path.open("w") as f:
-                f.write(ut.DATA["cookies"]["current"])
-            await cmds.cookies_menu(update, context)
-        elif query.data.startswith("inline"):
-            args = query.data.split("_")
-            await cmds.switch_inline_image(
-                update, context, int(args[-3]), args[-2], int(args[-1])
-            )
+        handler = parse_callback(query.data)
+        if handler is not None:
+            func, args = handler
+            await func(update, context, *args)
 
 
 def setup_handlers(app: Application) -> None:
+    if recorder.enabled():
+        app.add_handler(TypeHandler(Update, recorder.update), group=-1)
+
     unlock_handler = CommandHandler("unlock", cmds.unlock)
     app.add_handler(unlock_handler)
 
@@ -166,12 +322,21 @@ def setup_handlers(app: Application) -> None:
     history_handler = CommandHandler("history_update", cmds.history_update)
     app.add_handler(history_handler)
 
+    reload_handler = CommandHandler("reload", cmds.reload)
+    app.add_handler(reload_handler)
+
     reset_handler = CommandHandler("reset", cmds.reset_bot)
     app.add_handler(reset_handler)
 
     update_handler = CommandHandler("update", cmds.update_file)
     app.add_handler(update_handler)
 
+    stats_handler = CommandHandler("stats", cmds.stats)
+    app.add_handler(stats_handler)
+
+    profile_handler = CommandHandler("profile", cmds.profile)
+    app.add_handler(profile_handler)
+
     cancel_handler = CommandHandler("cancel", cmds.cancel)
     app.add_handler(cancel_handler)
 
@@ -201,10 +366,18 @@ def setup_handlers(app: Application) -> None:
 
 
 async def shutdown(app: Application) -> None:
+    watchdog.stop()
+    backend.shutdown_asr()
+    backend.stop_image_workers()
+    await sessions.close()
+    await metrics.stop_server()
+    await tracing.flush()
+    recorder.stop()
     hist = {}
-    for chat_id, convs in ut.CONV["all"].items():
-        if chat_id not in hist:
-            hist[chat_id] = {}
+    for (bot, chat_id), convs in ut.CONV["all"].items():
+        chat = f"{bot}:{chat_id}"
+        if chat not in hist:
+            hist[chat] = {}
         for conv_id, (conv, prompt) in convs.items():
             conversation_id = conv.chat_hub.request.conversation_id
             conversation_signature = (
@@ -212,7 +385,7 @@ async def shutdown(app: Application) -> None:
             )
             client_id = conv.chat_hub.request.client_id
             if ut.chats("history"):
-                hist[chat_id][conv_id] = [
+                hist[chat][conv_id] = [
                     {
                         "conversation_id": conversation_id,
                         "conversation_signature": conversation_signature,
@@ -225,7 +398,8 @@ async def shutdown(app: Application) -> None:
                 await conv.delete_conversation()
             await conv.close()
     if hist:
-        with Path(ut.PATH["dir"]).joinpath("history.json").open("w") as f:
+        _path = Path(ut.PATH["dir"]).joinpath(shard.suffix("history.json"))
+        with _path.open("w") as f:
             json.dump(hist, f)
 
 
@@ -233,6 +407,77 @@ async def setup_commands(app: Application) -> None:
     await app.bot.set_my_commands(cmds.HELP)
 
 
+async def post_init(app: Application) -> None:
+    await setup_commands(app)
+    app.job_queue.run_repeating(
+        ut.refresh_voices,
+        ut.VOICE_REFRESH,
+        first=1 if ut.DATA["tts"] is None else ut.VOICE_REFRESH,
+        name="refresh_voices",
+    )
+    watchdog.start(float(ut.settings("watchdog_threshold")))
+    if shard.SHARD["index"] is not None:
+        app.job_queue.run_repeating(
+            ut.watch_config, ut.CONFIG_WATCH, first=0, name="watch_config"
+        )
+    app.job_queue.run_repeating(
+        tracing.flush, tracing.TRACE_FLUSH, name="flush_traces"
+    )
+    if int(ut.settings("metrics_port")):
+        await metrics.start_server(
+            ut.settings("metrics_listen"),
+            int(ut.settings("metrics_port")) + (shard.SHARD["index"] or 0),
+        )
+
+
+def worker_port(index: int) -> int:
+    return int(ut.settings("port")) + 1 + index
+
+
+async def set_webhook(token: str) -> None:
+    async with Bot(token) as bot:
+        cert = ut.settings("cert")
+        await bot.set_webhook(
+            f"https://{ut.settings('ip')}/{token}",
+            certificate=Path(cert).read_bytes() if cert else None,
+        )
+
+
+async def run_dispatcher(token: str, workers: int) -> None:
+    await set_webhook(token)
+    await shard.dispatch(
+        ut.settings("listen"),
+        int(ut.settings("port")),
+        token,
+        [worker_port(index) for index in range(workers)],
+        [sys.executable, *sys.argv],
+    )
+
+
+async def run_bots(apps: Dict[str, Application]) -> None:
+    if ut.settings("webhook"):
+        for token in apps:
+            await set_webhook(token)
+        await shard.serve(
+            apps, ut.settings("listen"), int(ut.settings("port"))
+        )
+    else:
+        await shard.serve(apps)
+
+
+def build_application(token: str, services: bool) -> Application:
+    builder = ApplicationBuilder().token(token).concurrent_updates(True)
+    if services:
+        builder = builder.post_init(post_init).post_shutdown(shutdown)
+    else:
+        builder = builder.post_init(setup_commands)
+    if shard.SHARD["index"] is not None:
+        builder = builder.updater(None)
+    application = builder.build()
+    setup_handlers(application)
+    return application
+
+
 def get_version():
     run_cmd = (
         lambda cmd: subprocess.check_output(
@@ -249,6 +494,15 @@ def get_version():
     return f"v{version} - {commit} (git)"
 
 
+class VersionAction(argparse.Action):
+    def __init__(self, option_strings: List[str], **kwargs: Any) -> None:
+        kwargs.update(dest=argparse.SUPPRESS, default=argparse.SUPPRESS)
+        super().__init__(option_strings, nargs=0, **kwargs)
+
+    def __call__(self, parser: argparse.ArgumentParser, *args: Any) -> None:
+        parser.exit(message=f"{parser.prog} {get_version()}\n")
+
+
 def setup_parser() -> None:
     parser = argparse.ArgumentParser(prog="edge-gpt-telegram-bot")
     parser.add_argument(
@@ -277,15 +531,31 @@ def setup_parser() -> None:
             "asr transcriptions..."
         ),
     )
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
     parser.add_argument(
-        "--version", action="version", version=f"%(prog)s {get_version()}"
+        "--record",
+        metavar="FILE",
+        help=(
+            "Append incoming updates and Bing stream timings, "
+            "without personal data, to a JSONL file (bench/replay.py)"
+        ),
+    )
+    parser.add_argument(
+        "--version",
+        action=VersionAction,
+        help="show program's version number and exit",
     )
     args = parser.parse_args()
 
     for k, v in vars(args).items():
         if k == "debug":
             ut.DEBUG = v
-        elif k != "version":
+        elif k == "worker":
+            shard.SHARD["index"] = v
+        elif k == "record":
+            if v is not None:
+                recorder.start(shard.suffix(v))
+        else:
             ut.PATH[k] = v
 
 
@@ -307,26 +577,51 @@ if __name__ == "__main__":
         )
 
     if ut.Path(ut.PATH["dir"]).joinpath(ut.PATH["config"]).exists():
+        try:
+            ut.load_config()
+        except KeyError as e:
+            logging.error(
+                f"Setting {e} missing in {ut.PATH['config']}. "
+                "Check templates/config.json"
+            )
+            sys.exit(1)
+        tokens = ut.tokens()
+        workers = int(ut.settings("workers"))
+        if workers > 1 and shard.SHARD["index"] is None:
+            if ut.settings("webhook") and len(tokens) == 1:
+                asyncio.run(run_dispatcher(tokens[0], workers))
+            else:
+                logging.error(
+                    "'workers' setting requires 'webhook' and a single token."
+                )
+            sys.exit()
         ut.setup()
-        application = (
-            ApplicationBuilder()
-            .token(ut.settings("token"))
-            .post_init(setup_commands)
-            .post_shutdown(shutdown)
-            .concurrent_updates(True)
-            .build()
-        )
-        setup_handlers(application)
+        applications = {
+            token: build_application(token, not idx)
+            for idx, token in enumerate(tokens)
+        }
+        token = tokens[0]
+        application = applications[token]
         try:
-            if ut.settings("webhook"):
+            if shard.SHARD["index"] is not None:
+                loop = asyncio.get_event_loop()
+                loop.run_until_complete(
+                    shard.serve(
+                        {"": application},
+                        "127.0.0.1",
+                        worker_port(shard.SHARD["index"]),
+                    )
+                )
+            elif len(applications) > 1:
+                loop = asyncio.get_event_loop()
+                loop.run_until_complete(run_bots(applications))
+            elif ut.settings("webhook"):
                 application.run_webhook(
                     listen=ut.settings("listen"),
                     port=int(ut.settings("port")),
-                    url_path=ut.settings("token"),
+                    url_path=token,
                     cert=ut.settings("cert"),
-                    webhook_url=(
-                        f"https://{ut.settings('ip')}/{ut.settings('token')}"
-                    ),
+                    webhook_url=f"https://{ut.settings('ip')}/{token}",
                 )
             else:
                 application.run_polling()
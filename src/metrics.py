@@ -0,0 +1,222 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Tuple
+
+
+LATENCY = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+EDITS = (0, 1, 2, 4, 8, 16, 32, 64)
+LAG = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+REGISTRY = []
+SERVER = {"runner": None}
+
+
+def _labels(labels: Tuple[Tuple[str, str]], extra: str = "") -> str:
+    pairs = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        pairs.append(extra)
+    return f"{{{','.join(pairs)}}}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str) -> None:
+        self.name = name
+        self.doc = doc
+        self.values = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def expose(self) -> List[str]:
+        return [
+            f"{self.name}{_labels(key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, doc: str, buckets: Tuple[float] = LATENCY
+    ) -> None:
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        self.values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+        counts = self.values[key]
+        counts[0][bisect.bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+        counts[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def expose(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            acc = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                acc += bucket_count
+                le = f'le="{bucket}"'
+                lines.append(f"{self.name}_bucket{_labels(key, le)} {acc}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+class Rolling:
+    def __init__(
+        self,
+        window: int = 3600,
+        slots: int = 60,
+        buckets: Tuple[float] = LATENCY,
+    ) -> None:
+        self.step = window / slots
+        self.slots = slots
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            self.values[key] = (
+                [-1] * self.slots,
+                [[0] * (len(self.buckets) + 1) for _ in range(self.slots)],
+            )
+        stamps, counts = self.values[key]
+        slot = int(time.monotonic() // self.step)
+        idx = slot % self.slots
+        if stamps[idx] != slot:
+            stamps[idx] = slot
+            counts[idx] = [0] * (len(self.buckets) + 1)
+        counts[idx][bisect.bisect_left(self.buckets, value)] += 1
+
+    def counts(self, **labels: str) -> List[int]:
+        oldest = int(time.monotonic() // self.step) - self.slots
+        keys = self.values
+        if labels:
+            keys = [tuple(sorted(labels.items()))]
+        total = [0] * (len(self.buckets) + 1)
+        for key in keys:
+            if key in self.values:
+                stamps, counts = self.values[key]
+                for stamp, slot in zip(stamps, counts):
+                    if stamp > oldest:
+                        total = [acc + cnt for acc, cnt in zip(total, slot)]
+        return total
+
+    def count(self, **labels: str) -> int:
+        return sum(self.counts(**labels))
+
+    def quantile(self, q: float, **labels: str) -> float:
+        counts = self.counts(**labels)
+        target = q * sum(counts)
+        acc = 0
+        for bucket, cnt in zip(self.buckets + (float("inf"),), counts):
+            acc += cnt
+            if cnt and acc >= target:
+                return bucket
+        return 0
+
+
+def expose() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+async def handler(request: Any) -> Any:
+    from aiohttp import web
+
+    return web.Response(
+        text=expose(), content_type="text/plain", charset="utf-8"
+    )
+
+
+async def start_server(listen: str, port: int) -> None:
+    from aiohttp import web
+
+    app = web.Application()
+    app.add_routes([web.get("/metrics", handler)])
+    SERVER["runner"] = web.AppRunner(app, access_log=None)
+    await SERVER["runner"].setup()
+    await web.TCPSite(SERVER["runner"], listen, port).start()
+
+
+async def stop_server() -> None:
+    if SERVER["runner"] is not None:
+        await SERVER["runner"].cleanup()
+        SERVER["runner"] = None
+
+
+BING_QUEUE = Histogram(
+    "bing_queue_wait_seconds", "Time a turn waits for previous turns"
+)
+BING_FIRST = Histogram(
+    "bing_first_token_seconds", "Time until the first streamed chunk"
+)
+BING_ANSWER = Histogram(
+    "bing_answer_seconds", "Time until the final Bing response"
+)
+BING_EDITS = Histogram(
+    "bing_edits_per_answer", "Message edits while streaming", EDITS
+)
+BING_ANSWERS = Counter("bing_answers_total", "Bing answers by result")
+BING_STREAMS = Gauge("bing_streams", "Bing answers being streamed")
+ASR = Histogram("asr_seconds", "Voice note transcription time")
+ASR_REQUESTS = Counter("asr_requests_total", "Transcriptions by result")
+TTS = Histogram("tts_seconds", "Text-to-speech synthesis time")
+IMAGE_WAIT = Histogram(
+    "image_queue_wait_seconds", "Time an image prompt waits for a worker"
+)
+IMAGE_GENERATION = Histogram(
+    "image_generation_seconds", "Bing Image Creator generation time"
+)
+IMAGE_REQUESTS = Counter("image_requests_total", "Image generations by result")
+CACHE = Counter("cache_requests_total", "Cache lookups by result")
+HTTP_CONNECTIONS = Counter(
+    "http_connections_total", "Outbound HTTP connections, new or reused"
+)
+ANSWERS_HOUR = Rolling()
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "Event loop scheduling lag", LAG
+)
+LOOP_BLOCKED = Counter(
+    "event_loop_blocked_total", "Callbacks blocking the loop over threshold"
+)
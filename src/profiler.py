@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import asyncio
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Tuple
+
+
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX = 300
+PROFILE_TOP = 30
+PROFILE = {"running": False}
+
+
+def collapse(frame: FrameType) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample(seconds: float) -> Counter:
+    stacks = Counter()
+    me = threading.get_ident()
+    names = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if ident not in names:
+                names = {th.ident: th.name for th in threading.enumerate()}
+            stacks[f"{names.get(ident, ident)};{collapse(frame)}"] += 1
+        time.sleep(PROFILE_INTERVAL)
+    return stacks
+
+
+def allocations(
+    before: tracemalloc.Snapshot, after: tracemalloc.Snapshot
+) -> str:
+    stats = after.compare_to(before, "lineno")[:PROFILE_TOP]
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [
+        f"Traced memory: current {current / 2**20:.1f} MiB, "
+        f"peak {peak / 2**20:.1f} MiB",
+        f"Top {len(stats)} allocation sites by growth:",
+    ]
+    lines.extend(str(stat) for stat in stats)
+    return "\n".join(lines)
+
+
+async def profile(seconds: float, memory: bool = False) -> Tuple[str, str]:
+    PROFILE["running"] = True
+    started = False
+    try:
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started = True
+            before = tracemalloc.take_snapshot()
+        loop = asyncio.get_running_loop()
+        stacks = await loop.run_in_executor(None, sample, seconds)
+        report = ""
+        if memory:
+            report = allocations(before, tracemalloc.take_snapshot())
+    finally:
+        if started:
+            tracemalloc.stop()
+        PROFILE["running"] = False
+    collapsed = "".join(
+        f"{stack} {count}\n" for stack, count in stacks.most_common()
+    )
+    return collapsed, report
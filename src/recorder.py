@@ -0,0 +1,120 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, List, Tuple
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+
+RECORD = {"file": None, "start": 0, "salt": b""}
+USER_KEYS = (
+    "from",
+    "chat",
+    "user",
+    "sender_chat",
+    "forward_from",
+    "forward_from_chat",
+    "new_chat_members",
+    "left_chat_member",
+    "via_bot",
+)
+ID_KEYS = ("user_id", "user_chat_id")
+TEXT_KEYS = ("text", "caption", "query")
+FILE_KEYS = ("file_id", "file_unique_id")
+DROP_KEYS = (
+    "last_name",
+    "username",
+    "title",
+    "phone_number",
+    "contact",
+    "location",
+    "venue",
+    "file_name",
+    "performer",
+)
+PLACEHOLDERS = {"first_name": "User"}
+WORD = re.compile(r"\S")
+
+
+def start(path: str) -> None:
+    RECORD["file"] = open(path, "a", buffering=1)
+    RECORD["start"] = time.monotonic()
+    RECORD["salt"] = os.urandom(16)
+
+
+def stop() -> None:
+    if RECORD["file"] is not None:
+        RECORD["file"].close()
+        RECORD["file"] = None
+
+
+def enabled() -> bool:
+    return RECORD["file"] is not None
+
+
+def write(kind: str, **data: Any) -> None:
+    if enabled():
+        data.update(t=round(time.monotonic() - RECORD["start"], 3), type=kind)
+        RECORD["file"].write(f"{json.dumps(data)}\n")
+
+
+def digest(value: Any) -> str:
+    return hashlib.sha256(RECORD["salt"] + str(value).encode()).hexdigest()
+
+
+def pseudonym(value: int) -> int:
+    anon = int(digest(value)[:8], 16) % 10**9 + 10**9
+    return -anon if value < 0 else anon
+
+
+def scrub_text(text: str) -> str:
+    command, sep, rest = text.partition(" ")
+    if command.startswith("/"):
+        return f"{command}{sep}{WORD.sub('x', rest)}"
+    return WORD.sub("x", text)
+
+
+def scrub(obj: Any, parent: str = "") -> Any:
+    if isinstance(obj, list):
+        return [scrub(item, parent) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    clean = {}
+    for key, value in obj.items():
+        if key in DROP_KEYS:
+            continue
+        if key in PLACEHOLDERS:
+            clean[key] = PLACEHOLDERS[key]
+        elif (key == "id" and parent in USER_KEYS) or key in ID_KEYS:
+            clean[key] = pseudonym(value)
+        elif key in TEXT_KEYS and isinstance(value, str):
+            clean[key] = scrub_text(value)
+        elif key in FILE_KEYS:
+            clean[key] = digest(value)[:32]
+        else:
+            clean[key] = scrub(value, key)
+    return clean
+
+
+async def update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    write("update", update=scrub(update.to_dict()))
+
+
+def stream(
+    cid: int, chunks: List[Tuple[float, int]], result: str, length: int
+) -> None:
+    write(
+        "stream",
+        chat=pseudonym(cid),
+        chunks=chunks,
+        result=result,
+        length=length,
+    )
@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable
+
+import aiohttp
+
+import metrics
+
+
+HTTP_POOL_LIMIT = 20
+HTTP_KEEPALIVE = 60
+HTTP_DNS_TTL = 300
+SESSIONS = {}
+CLIENTS = {}
+
+
+def trace(name: str) -> aiohttp.TraceConfig:
+    async def created(
+        session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any
+    ) -> None:
+        metrics.HTTP_CONNECTIONS.inc(session=name, result="new")
+
+    async def reused(
+        session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any
+    ) -> None:
+        metrics.HTTP_CONNECTIONS.inc(session=name, result="reused")
+
+    config = aiohttp.TraceConfig()
+    config.on_connection_create_end.append(created)
+    config.on_connection_reuseconn.append(reused)
+    return config
+
+
+def get(name: str) -> aiohttp.ClientSession:
+    if SESSIONS.get(name) is None or SESSIONS[name].closed:
+        SESSIONS[name] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                keepalive_timeout=HTTP_KEEPALIVE,
+                ttl_dns_cache=HTTP_DNS_TTL,
+            ),
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trace_configs=[trace(name)],
+        )
+    return SESSIONS[name]
+
+
+@asynccontextmanager
+async def client(name: str, key: Any, factory: Callable) -> AsyncIterator:
+    current = CLIENTS.get(name)
+    if current is None or current["key"] != key:
+        if current is not None:
+            current["stale"] = True
+            if not current["users"]:
+                await current["client"].__aexit__(None, None, None)
+        current = CLIENTS[name] = {
+            "key": key,
+            "client": await factory().__aenter__(),
+            "users": 0,
+            "stale": False,
+        }
+    current["users"] += 1
+    try:
+        yield current["client"]
+    finally:
+        current["users"] -= 1
+        if current["stale"] and not current["users"]:
+            await current["client"].__aexit__(None, None, None)
+
+
+async def close() -> None:
+    for name, session in SESSIONS.items():
+        if session is not None:
+            await session.close()
+            SESSIONS[name] = None
+    for current in CLIENTS.values():
+        await current["client"].__aexit__(None, None, None)
+    CLIENTS.clear()
@@ -0,0 +1,245 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import re
+import signal
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import aiohttp
+
+from telegram import Update
+from telegram.ext import Application
+
+
+SHARD_REPLICAS = 64
+SHARD_BATCH = 100
+SHARD_RETRY = 1
+SHARD = {"index": None, "workers": 1, "keys": [], "nodes": []}
+INLINE_OWNER = re.compile(r"inline_\d+_[^_]+_-?\d+_(\d+)")
+
+
+def digest(value: Any) -> int:
+    return int(hashlib.sha1(str(value).encode()).hexdigest()[:16], 16)
+
+
+def setup(workers: int) -> None:
+    ring = sorted(
+        (digest(f"worker-{node}-{replica}"), node)
+        for node in range(workers)
+        for replica in range(SHARD_REPLICAS)
+    )
+    SHARD["workers"] = workers
+    SHARD["keys"] = [key for key, _ in ring]
+    SHARD["nodes"] = [node for _, node in ring]
+
+
+def worker(chat_id: int) -> int:
+    if SHARD["workers"] < 2:
+        return 0
+    idx = bisect.bisect(SHARD["keys"], digest(chat_id))
+    return SHARD["nodes"][idx % len(SHARD["nodes"])]
+
+
+def owns(chat_id: int) -> bool:
+    return SHARD["index"] is None or worker(chat_id) == SHARD["index"]
+
+
+def suffix(name: str) -> str:
+    if SHARD["index"] is None:
+        return name
+    _path = Path(name)
+    return str(_path.with_name(f"{_path.stem}-{SHARD['index']}{_path.suffix}"))
+
+
+def chat_key(data: dict) -> int:
+    query = data.get("callback_query", {})
+    if "inline_message_id" in query:
+        owner = INLINE_OWNER.fullmatch(query.get("data", ""))
+        if owner is not None:
+            return int(owner.group(1))
+    for value in data.values():
+        if isinstance(value, dict):
+            chat = value.get("chat") or value.get("message", {}).get("chat")
+            if chat is not None:
+                return chat["id"]
+            if "from" in value:
+                return value["from"]["id"]
+    return 0
+
+
+def stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+async def forward(
+    session: aiohttp.ClientSession, url: str, queue: asyncio.Queue
+) -> None:
+    while True:
+        batch = [await queue.get()]
+        while not queue.empty() and len(batch) < SHARD_BATCH:
+            batch.append(queue.get_nowait())
+        body = b"[" + b",".join(batch) + b"]"
+        while True:
+            try:
+                async with session.post(
+                    url,
+                    data=body,
+                    headers={"Content-Type": "application/json"},
+                ) as resp:
+                    if resp.status >= 400:
+                        logging.getLogger("Shard").error(
+                            f"{url}: {resp.status}, "
+                            f"dropping {len(batch)} updates"
+                        )
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.getLogger("Shard").warning(
+                    f"{url}: {e!r}, retrying {len(batch)} updates"
+                )
+                await asyncio.sleep(SHARD_RETRY)
+
+
+async def supervise(
+    index: int, argv: List[str], procs: list, stop: asyncio.Event
+) -> None:
+    while not stop.is_set():
+        procs[index] = await asyncio.create_subprocess_exec(
+            *argv, "--worker", str(index)
+        )
+        code = await procs[index].wait()
+        if not stop.is_set():
+            logging.getLogger("Shard").error(
+                f"Worker {index} exited with code {code}, restarting"
+            )
+            await asyncio.sleep(SHARD_RETRY)
+
+
+async def dispatch(
+    listen: str,
+    port: int,
+    url_path: str,
+    ports: List[int],
+    argv: List[str] = None,
+    stop: asyncio.Event = None,
+) -> None:
+    from aiohttp import web
+
+    setup(len(ports))
+    queues = [asyncio.Queue() for _ in ports]
+
+    async def webhook(request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        queues[worker(chat_key(data))].put_nowait(body)
+        return web.Response()
+
+    if stop is None:
+        stop = stop_event()
+    procs = [None] * len(ports)
+    tasks = []
+    if argv is not None:
+        tasks.extend(
+            asyncio.ensure_future(supervise(index, argv, procs, stop))
+            for index in range(len(ports))
+        )
+    server = web.Application()
+    server.add_routes(
+        [
+            web.post(f"/{url_path}", webhook),
+            web.post(f"/{url_path}/", webhook),
+        ]
+    )
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, listen, port).start()
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0)
+    ) as session:
+        tasks.extend(
+            asyncio.ensure_future(
+                forward(session, f"http://127.0.0.1:{wport}/", queue)
+            )
+            for wport, queue in zip(ports, queues)
+        )
+        await stop.wait()
+        await runner.cleanup()
+        for proc in procs:
+            if proc is not None and proc.returncode is None:
+                proc.terminate()
+        await asyncio.gather(
+            *(proc.wait() for proc in procs if proc is not None)
+        )
+        for task in tasks:
+            task.cancel()
+
+
+async def serve(
+    apps: Dict[str, Application], listen: str = None, port: int = None
+) -> None:
+    from aiohttp import web
+
+    def receiver(app: Application) -> Callable:
+        async def receive(request: web.Request) -> web.Response:
+            try:
+                data = await request.json()
+            except ValueError:
+                return web.Response(status=400)
+            updates = []
+            for item in data if isinstance(data, list) else [data]:
+                try:
+                    updates.append(Update.de_json(item, app.bot))
+                except Exception as e:  # noqa
+                    logging.getLogger("Shard").error(
+                        f"Skipping invalid update: {e}"
+                    )
+            for update in updates:
+                await app.update_queue.put(update)
+            return web.Response()
+
+        return receive
+
+    stop = stop_event()
+    server = web.Application(client_max_size=0)
+    for path, app in apps.items():
+        await app.initialize()
+        if app.post_init is not None:
+            await app.post_init(app)
+        await app.start()
+        if port is None:
+            await app.updater.start_polling()
+        else:
+            server.add_routes([web.post(f"/{path}", receiver(app))])
+            if path:
+                server.add_routes([web.post(f"/{path}/", receiver(app))])
+    runner = web.AppRunner(server, access_log=None)
+    if port is not None:
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        for app in apps.values():
+            if app.updater is not None and app.updater.running:
+                await app.updater.stop()
+            await app.stop()
+        for app in apps.values():
+            await app.shutdown()
+        for app in apps.values():
+            if app.post_shutdown is not None:
+                await app.post_shutdown(app)
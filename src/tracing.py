@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Union
+from uuid import uuid4
+
+import aiohttp
+import sessions
+import shard
+
+import utils as ut
+
+
+CURRENT = ContextVar("span", default=None)
+SPANS = []
+TRACE_FLUSH = 5
+TRACE_BUFFER = 10000
+
+
+def sampled() -> bool:
+    rate = float(ut.settings("trace_sample"))
+    return rate > 0 and random.random() < rate
+
+
+def begin(
+    name: str, root: bool = False, **attrs: Any
+) -> Union[Dict[str, Any], None]:
+    parent = CURRENT.get()
+    if parent is None:
+        if not root or not sampled():
+            return None
+        trace_id = uuid4().hex
+        parent_id = ""
+    else:
+        trace_id = parent["trace_id"]
+        parent_id = parent["span_id"]
+    return {
+        "trace_id": trace_id,
+        "span_id": uuid4().hex[:16],
+        "parent_span_id": parent_id,
+        "name": name,
+        "start": time.time_ns(),
+        "end": None,
+        "status": "ok",
+        "attributes": attrs,
+    }
+
+
+def end(span: Union[Dict[str, Any], None], **attrs: Any) -> None:
+    if span is not None:
+        span["end"] = time.time_ns()
+        span["attributes"].update(attrs)
+        if len(SPANS) < TRACE_BUFFER:
+            SPANS.append(span)
+
+
+def fail(span: Union[Dict[str, Any], None], error: Exception) -> None:
+    if span is not None:
+        span["status"] = "error"
+        span["attributes"]["error"] = repr(error)
+
+
+def annotate(**attrs: Any) -> None:
+    span = CURRENT.get()
+    if span is not None:
+        span["attributes"].update(attrs)
+
+
+@contextmanager
+def span(
+    name: str, root: bool = False, **attrs: Any
+) -> Iterator[Union[Dict[str, Any], None]]:
+    record = begin(name, root, **attrs)
+    if record is None:
+        yield None
+        return
+    token = CURRENT.set(record)
+    try:
+        yield record
+    except Exception as e:
+        fail(record, e)
+        raise
+    finally:
+        CURRENT.reset(token)
+        end(record)
+
+
+def traced(name: str, root: bool = False) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name, root):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def otlp(spans: list) -> Dict[str, Any]:
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {
+                            "key": "service.name",
+                            "value": {"stringValue": "edgegpt-bot"},
+                        }
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "edgegpt-bot"},
+                        "spans": [
+                            {
+                                "traceId": sp["trace_id"],
+                                "spanId": sp["span_id"],
+                                "parentSpanId": sp["parent_span_id"],
+                                "name": sp["name"],
+                                "kind": 1,
+                                "startTimeUnixNano": str(sp["start"]),
+                                "endTimeUnixNano": str(sp["end"]),
+                                "attributes": [
+                                    {
+                                        "key": key,
+                                        "value": {"stringValue": str(value)},
+                                    }
+                                    for key, value in sp["attributes"].items()
+                                ],
+                                "status": {
+                                    "code": 2 if sp["status"] == "error" else 1
+                                },
+                            }
+                            for sp in spans
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+async def flush(context: Any = None) -> None:
+    if not SPANS:
+        return
+    spans = SPANS.copy()
+    SPANS.clear()
+    trace_file = ut.settings("trace_file")
+    if trace_file:
+        _path = Path(ut.PATH["dir"]).joinpath(shard.suffix(trace_file))
+        with _path.open("a") as f:
+            f.writelines(f"{json.dumps(sp)}\n" for sp in spans)
+    endpoint = ut.settings("trace_endpoint")
+    if endpoint:
+        try:
+            async with sessions.get("otlp").post(
+                endpoint, json=otlp(spans)
+            ) as resp:
+                resp.raise_for_status()
+        except aiohttp.ClientError as e:
+            logging.getLogger("Tracing").error(
+                f"Could not export {len(spans)} spans: {e}"
+            )
@@ -8,21 +8,20 @@ import asyncio
 import json
 import logging
 import re
-
+import resource
+import time
 import traceback
+from collections import OrderedDict
 
 from pathlib import Path
 from threading import Thread
-from typing import Dict, List, Tuple, Union
-
-import aiohttp
+from typing import Any, Callable, Dict, List, Tuple, Union
 
 import database as db
 
-import edge_tts
-
-from EdgeGPT.EdgeGPT import Chatbot
-from EdgeGPT.request import ChatHubRequest
+import metrics
+import sessions
+import shard
 
 from telegram import (
     constants,
@@ -40,11 +39,11 @@ from telegram.ext import ContextTypes
 PATH = {}
 DATA = {
     "config": None,
-    "cookies": {"all": {}, "current": {}, "_U": {}},
+    "cookies": {"all": {}, "current": "", "_U": {}},
     "tts": None,
     "msg": {},
 }
-CONV = {"all": {}, "current": {}}
+CONV = {"all": {}, "current": {}, "cookie": {}}
 RUN = {}
 LOG_FILT = [
     "Removed job",
@@ -55,8 +54,29 @@ LOG_FILT = [
     "HTTP Request",
 ]
 DEBUG = False
+VOICE_REFRESH = 86400
+RELOAD_DRAIN = 1
+CONFIG_WATCH = 10
+WATCHED = {}
+DEFAULTS = {
+    "asr_model": "base",
+    "asr_compute_type": "int8",
+    "asr_workers": 1,
+    "image_workers": 2,
+    "image_rate": 15,
+    "image_upload": False,
+    "metrics_listen": "127.0.0.1",
+    "metrics_port": 0,
+    "trace_endpoint": "",
+    "trace_file": "traces.jsonl",
+    "trace_sample": 0,
+    "watchdog_threshold": 1,
+    "workers": 1,
+}
 STATE = {}
-MEDIA = {}
+AUTH = {"allowed": set(), "admin": set(), "unlocked": set()}
+MEDIA_TTL = 86400
+KEYBOARDS = {}
 BING = (
     "http://upload.wikimedia.org/wikipedia/commons/thumb/9/9c/"
     "Bing_Fluent_Logo.svg/32px-Bing_Fluent_Logo.svg.png"
@@ -77,6 +97,31 @@ CHAT_END = [
 ]
 
 
+class Cache:
+    def __init__(self, ttl: float, size: int) -> None:
+        self.ttl = ttl
+        self.size = size
+        self.data = OrderedDict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key in self.data:
+            expiration, value = self.data[key]
+            if expiration > time.monotonic():
+                self.data.move_to_end(key)
+                return value
+            del self.data[key]
+        return default
+
+    def set(self, key: Any, value: Any) -> None:
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+MEDIA = Cache(MEDIA_TTL, 1024)
+
+
 class NoLog(logging.Filter):
     def filter(self, record: logging.LogRecord):
         logged = True
@@ -107,57 +152,68 @@ def rename_files() -> None:
                 tmp.rename(cfg.joinpath(v))
 
 
-def init_chat(chat_id: int) -> None:
-    if chat_id not in CONV["all"]:
-        CONV["all"][chat_id] = {}
-        CONV["current"][chat_id] = ""
-        RUN[chat_id] = {}
+def init_chat(chat: Tuple[int, int]) -> None:
+    if chat not in CONV["all"]:
+        CONV["all"][chat] = {}
+        CONV["current"][chat] = ""
+        RUN[chat] = {}
 
 
-def load_chat(conv_data: List, chat_id: int = None) -> None:
+def load_chat(conv_data: List, chat: Tuple[int, int] = None) -> None:
     short = conv_data[0]["conversation_id"].split("|")[2][:10]
-    if chat_id is None:
-        chat_id = chats("admin")[0]
-    init_chat(chat_id)
-    if short not in CONV["all"][chat_id]:
+    if chat is None:
+        chat = (bot_id(tokens()[0]), chats("admin")[0])
+    init_chat(chat)
+    if short not in CONV["all"][chat]:
+        from EdgeGPT.request import ChatHubRequest
+
         tmp = create_chatbot()
         tmp.chat_hub.request = ChatHubRequest(**conv_data[0])
-        CONV["all"][chat_id][short] = [tmp, conv_data[1]]
-        RUN[chat_id][short] = []
+        CONV["all"][chat][short] = [tmp, conv_data[1]]
+        CONV["cookie"][short] = current_cookie()
+        RUN[chat][short] = []
 
 
 async def retrieve_history() -> None:
     curr = DATA["cookies"]["current"]
     head = CHAT_END[1].copy()
     head["Cookie"] = "SUID=A; _U={};".format(DATA["cookies"]["_U"][curr])
-    async with aiohttp.ClientSession(headers=head) as session:
-        async with session.get(CHAT_END[0]) as resp:
-            data = json.loads(await resp.text())
-            if data["chats"]:
-                client_id = data["clientId"]
-                CONV["all"].clear()
-                CONV["current"].clear()
-                RUN.clear()
-                for chat in data["chats"]:
-                    name = chat["chatName"]
-                    conversation_id = chat["conversationId"]
-                    signature = chat["conversationSignature"]
-                    thread = Thread(
-                        target=load_chat,
-                        args=(
-                            [
-                                {
-                                    "conversation_id": conversation_id,
-                                    "conversation_signature": signature,
-                                    "client_id": client_id,
-                                    "invocation_id": 4,
-                                },
-                                name,
-                            ],
-                        ),
-                        daemon=True,
-                    )
-                    thread.start()
+    async with sessions.get("bing").get(CHAT_END[0], headers=head) as resp:
+        data = json.loads(await resp.text())
+        if data["chats"]:
+            client_id = data["clientId"]
+            CONV["all"].clear()
+            CONV["current"].clear()
+            CONV["cookie"].clear()
+            RUN.clear()
+            for chat in data["chats"]:
+                name = chat["chatName"]
+                conversation_id = chat["conversationId"]
+                signature = chat["conversationSignature"]
+                thread = Thread(
+                    target=load_chat,
+                    args=(
+                        [
+                            {
+                                "conversation_id": conversation_id,
+                                "conversation_signature": signature,
+                                "client_id": client_id,
+                                "invocation_id": 4,
+                            },
+                            name,
+                        ],
+                    ),
+                    daemon=True,
+                )
+                thread.start()
+
+
+def load_config() -> None:
+    with open(path("config")) as f:
+        config = json.load(f)
+    set_defaults(config)
+    DATA["config"] = config
+    shard.setup(int(settings("workers")))
 
 
 def setup() -> None:
@@ -165,29 +221,11 @@ def setup() -> None:
     db.setup_db()
     db.update_db()
     rename_files()
-    with open(path("config")) as f:
-        DATA["config"] = json.load(f)
-    missing = False
-    if "remove_chats_on_stop" not in DATA["config"]["chats"]:
-        DATA["config"]["chats"]["remove_chats_on_stop"] = False
-        missing = True
-    if "history" not in DATA["config"]["chats"]:
-        DATA["config"]["chats"]["history"] = True
-        missing = True
-    if missing:
-        logging.error(
-            "New setting is missing, using default value. "
-            "Check README for more info."
-        )
-    for cookie in DATA["config"]["cookies"]:
-        _path = Path(cookie)
-        if _path.exists():
-            with _path.open() as f:
-                DATA["cookies"]["all"][_path.stem] = json.load(f)
-            for ck in DATA["cookies"]["all"][_path.stem]:
-                if ck["name"] == "_U":
-                    DATA["cookies"]["_U"][_path.stem] = ck["value"]
-                    break
+    load_voices()
+    load_config()
+    load_auth()
+    DATA["cookies"]["all"] = read_cookies(DATA["config"]["cookies"])
+    DATA["cookies"]["_U"] = cookies_u(DATA["cookies"]["all"])
     if DATA["cookies"]["all"]:
         _path = Path(PATH["dir"]).joinpath("current_cookie")
         if _path.exists():
@@ -198,34 +236,121 @@ def setup() -> None:
             with _path.open("w") as f:
                 f.write(DATA["cookies"]["current"])
         if chats("history"):
-            _path = Path(PATH["dir"]).joinpath("history.json")
+            _path = Path(PATH["dir"]).joinpath(shard.suffix("history.json"))
             if not _path.exists():
-                loop = asyncio.get_event_loop()
-                loop.create_task(retrieve_history())
+                if shard.owns(chats("admin")[0]):
+                    loop = asyncio.get_event_loop()
+                    loop.create_task(retrieve_history())
             else:
                 added = []
                 with _path.open() as f:
                     hist = json.load(f)
-                    for chat_id, conv in hist.items():
-                        chat_id = int(chat_id)
+                    for chat, conv in hist.items():
+                        chat = history_key(chat)
                         for _, (conv_metadata, prompt) in conv.items():
                             thread = Thread(
                                 target=load_chat,
-                                args=([conv_metadata, prompt], chat_id),
+                                args=([conv_metadata, prompt], chat),
                                 daemon=True,
                             )
                             thread.start()
                             added.append(conv_metadata["conversation_id"])
+    set_log_level()
+
+
+def set_defaults(config: Dict) -> None:
+    for key in ("settings", "chats", "cookies"):
+        if key not in config:
+            raise KeyError(key)
+    config.setdefault("apis", {})
+    for key in ("id", "admin"):
+        if key not in config["chats"]:
+            raise KeyError(f"chats.{key}")
+    missing = False
+    if "remove_chats_on_stop" not in config["chats"]:
+        config["chats"]["remove_chats_on_stop"] = False
+        missing = True
+    if "history" not in config["chats"]:
+        config["chats"]["history"] = True
+        missing = True
+    if missing:
+        logging.error(
+            "New setting is missing, using default value. "
+            "Check README for more info."
+        )
+    for key, value in DEFAULTS.items():
+        config["settings"].setdefault(key, value)
+
+
+def set_log_level() -> None:
     try:
         logging.getLogger().setLevel(settings("log_level").upper())
     except KeyError:
         pass
 
 
+def read_cookies(paths: List[str]) -> Dict[str, List]:
+    cookies = {}
+    for cookie in paths:
+        _path = Path(cookie)
+        if _path.exists():
+            with _path.open() as f:
+                cookies[_path.stem] = json.load(f)
+    return cookies
+
+
+def cookies_u(cookies: Dict[str, List]) -> Dict[str, str]:
+    _u = {}
+    for name, cookie in cookies.items():
+        for ck in cookie:
+            if ck["name"] == "_U":
+                _u[name] = ck["value"]
+                break
+    return _u
+
+
+def apply_cookies(cookies: Dict[str, List]) -> List[str]:
+    changed = [
+        name
+        for name, cookie in DATA["cookies"]["all"].items()
+        if cookies.get(name) != cookie
+    ]
+    DATA["cookies"]["all"] = cookies
+    DATA["cookies"]["_U"] = cookies_u(cookies)
+    if DATA["cookies"]["current"] not in cookies:
+        DATA["cookies"]["current"] = next(iter(cookies), "")
+        with Path(PATH["dir"]).joinpath("current_cookie").open("w") as f:
+            f.write(DATA["cookies"]["current"])
+    return changed
+
+
+def apply_config(config: Dict) -> List[str]:
+    set_defaults(config)
+    cookies = read_cookies(config["cookies"])
+    DATA["config"] = config
+    load_auth()
+    set_log_level()
+    return apply_cookies(cookies)
+
+
 def settings(key: str) -> Union[str, List]:
     return DATA["config"]["settings"][key]
 
 
+def tokens() -> List[str]:
+    token = settings("token")
+    return token if isinstance(token, list) else [token]
+
+
+def bot_id(token: str) -> int:
+    return int(token.split(":")[0])
+
+
+def history_key(key: str) -> Tuple[int, int]:
+    bot, _, chat = key.rpartition(":")
+    return int(bot) if bot else bot_id(tokens()[0]), int(chat)
+
+
 def apis(key: str) -> str:
     return DATA["config"]["apis"][key]
 
@@ -246,13 +371,36 @@ def passwd_correct(passwd: str) -> bool:
     return passwd == DATA["config"]["chats"]["password"]
 
 
+def load_auth() -> None:
+    AUTH["allowed"] = set(chats("id"))
+    AUTH["admin"] = set(chats("admin"))
+    AUTH["unlocked"] = set(db.users())
+
+
 def whitelisted(_cid: int) -> bool:
-    return _cid in chats("id")
+    return _cid in AUTH["allowed"]
+
+
+def unlocked(_cid: int) -> bool:
+    return _cid in AUTH["unlocked"]
+
+
+def is_admin(_cid: int) -> bool:
+    return _cid in AUTH["admin"]
+
+
+def unlock(_cid: int) -> None:
+    db.add_user(_cid)
+    AUTH["unlocked"].add(_cid)
 
 
 def add_whitelisted(_cid: int) -> None:
-    if whitelisted(_cid) and not db.cached(_cid):
-        db.add_user(_cid)
+    if whitelisted(_cid) and not unlocked(_cid):
+        unlock(_cid)
+
+
+def conv_key(update: Update) -> Tuple[int, int]:
+    return update.get_bot().id, cid(update)
 
 
 def cid(update: Update) -> int:
@@ -290,6 +438,33 @@ def markup(buttons: List[List[InlineKeyboardButton]]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(buttons)
 
 
+def keyboard(
+    key: Tuple,
+    build: Callable[[], List[List[Tuple[str, str]]]],
+    current: str = None,
+) -> InlineKeyboardMarkup:
+    if key not in KEYBOARDS:
+        metrics.CACHE.inc(cache="keyboard", result="miss")
+        rows = button_list(build())
+        index = {
+            kb.callback_data: idx for idx, kbs in enumerate(rows) for kb in kbs
+        }
+        KEYBOARDS[key] = (rows, index, markup(rows))
+    else:
+        metrics.CACHE.inc(cache="keyboard", result="hit")
+    rows, index, cached = KEYBOARDS[key]
+    if current not in index:
+        return cached
+    rows = list(rows)
+    rows[index[current]] = [
+        kb
+        if kb.callback_data != current
+        else InlineKeyboardButton(f"» {kb.text} «", callback_data=current)
+        for kb in rows[index[current]]
+    ]
+    return markup(rows)
+
+
 def button_query(update: Update, index: str) -> str:
     for kbs in update.effective_message.reply_markup.inline_keyboard:
         for kb in kbs:
@@ -297,32 +472,84 @@ def button_query(update: Update, index: str) -> str:
                 return kb.text
 
 
+def rss() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
 def chunk(lst: List[str], size: int = 6) -> List[str]:
     for idx in range(0, len(lst), size):
         yield lst[idx : idx + size]
 
 
+def voice_catalog(
+    voices: List[Tuple[str, str, str]]
+) -> Dict[str, Dict[str, List[str]]]:
+    catalog = {}
+    for name, lang, gend in voices:
+        if lang not in catalog:
+            catalog[lang] = {}
+        if gend not in catalog[lang]:
+            catalog[lang][gend] = []
+        catalog[lang][gend].append(name)
+    return catalog
+
+
+def load_voices() -> None:
+    voices = db.voices()
+    if voices:
+        DATA["tts"] = voice_catalog(voices)
+        KEYBOARDS.clear()
+        db.reset_invalid_voices()
+
+
+async def refresh_voices(context: ContextTypes.DEFAULT_TYPE = None) -> None:
+    import edge_tts
+
+    try:
+        voices = [
+            (vc["ShortName"], vc["Locale"].split("-")[0], vc["Gender"])
+            for vc in await edge_tts.list_voices()
+        ]
+    except Exception as e:
+        logging.getLogger("edge-tts").error(
+            f"Could not retrieve voice list: {e}"
+        )
+    else:
+        if voices:
+            db.set_voices(voices)
+            reset = db.reset_invalid_voices()
+            if reset:
+                logging.getLogger("edge-tts").info(
+                    f"Voice of {reset} users no longer available, "
+                    f"restored to {db.DEFAULT_VOICE}"
+                )
+            DATA["tts"] = voice_catalog(voices)
+            KEYBOARDS.clear()
+        else:
+            logging.getLogger("edge-tts").error(
+                "Retrieved an empty voice list, keeping the previous one"
+            )
+
+
 async def list_voices() -> Dict[str, Dict[str, List[str]]]:
     if DATA["tts"] is None:
-        DATA["tts"] = {}
-        voices = await edge_tts.list_voices()
-        for vc in voices:
-            lang = vc["Locale"].split("-")[0]
-            gend = vc["Gender"]
-            if lang not in DATA["tts"]:
-                DATA["tts"][lang] = {}
-            if gend not in DATA["tts"][lang]:
-                DATA["tts"][lang][gend] = []
-            DATA["tts"][lang][gend].append(vc["ShortName"])
-    return DATA["tts"]
+        await refresh_voices()
+    return DATA["tts"] or {}
 
 
 async def _remove_conversation(context: ContextTypes.DEFAULT_TYPE) -> None:
-    _cid, conv_id = context.job.data
-    _cid = int(_cid)
-    await CONV["all"][_cid][conv_id][0].close()
-    del CONV["all"][_cid][conv_id]
-    CONV["current"][_cid] = ""
+    chat, conv_id = context.job.data
+    await CONV["all"][chat][conv_id][0].close()
+    del CONV["all"][chat][conv_id]
+    CONV["cookie"].pop(conv_id, None)
+    CONV["current"][chat] = ""
 
 
 def delete_job(context: ContextTypes.DEFAULT_TYPE, name: str) -> None:
@@ -441,7 +668,13 @@ async def remove_conv_buttons(update: Update) -> None:
     )
 
 
-def create_chatbot() -> Chatbot:
+def current_cookie() -> str:
+    return DATA["cookies"]["current"] or "none"
+
+
+def create_chatbot() -> Any:
+    from EdgeGPT.EdgeGPT import Chatbot
+
     if DATA["cookies"]["all"]:
         cur_cookies = DATA["cookies"]["current"]
         tmp = Chatbot(cookies=DATA["cookies"]["all"][cur_cookies])
@@ -451,36 +684,107 @@ def create_chatbot() -> Chatbot:
 
 
 async def create_conversation(
-    update: Update, chat_id: Union[int, None] = None
+    update: Update, chat: Union[Tuple[int, int], None] = None
 ) -> str:
-    if chat_id is None:
-        chat_id = cid(update)
+    if chat is None:
+        chat = conv_key(update)
     try:
-        tmp = create_chatbot()
+        loop = asyncio.get_running_loop()
+        tmp = await loop.run_in_executor(None, create_chatbot)
     except Exception as e:
         logging.getLogger("EdgeGPT").error(e)
-        await send(update, f"EdgeGPT error: {e.args[0]}")
+        if update is not None:
+            await send(update, f"EdgeGPT error: {e.args[0]}")
         return ""
     else:
         conv_id = tmp.chat_hub.request.conversation_id.split("|")[2][:10]
-        CONV["all"][chat_id][conv_id] = [tmp, ""]
-        CONV["current"][chat_id] = conv_id
-        RUN[chat_id][conv_id] = []
+        CONV["all"][chat][conv_id] = [tmp, ""]
+        CONV["current"][chat] = conv_id
+        CONV["cookie"][conv_id] = current_cookie()
+        RUN[chat][conv_id] = []
     return conv_id
 
 
+def reload_config() -> List[str]:
+    with path("config").open() as f:
+        changed = apply_config(json.load(f))
+    _path = Path(PATH["dir"]).joinpath("current_cookie")
+    if _path.exists():
+        with _path.open() as f:
+            current = f.read().strip()
+        if current in DATA["cookies"]["all"]:
+            DATA["cookies"]["current"] = current
+    return changed
+
+
+def watched_files() -> Dict[str, float]:
+    files = [path("config"), Path(PATH["dir"]).joinpath("current_cookie")]
+    files.extend(Path(cookie) for cookie in DATA["config"]["cookies"])
+    return {str(f): f.stat().st_mtime if f.exists() else 0 for f in files}
+
+
+async def watch_config(context: ContextTypes.DEFAULT_TYPE = None) -> None:
+    if WATCHED and watched_files() != WATCHED:
+        try:
+            changed = reload_config()
+        except (OSError, ValueError, KeyError) as e:
+            logging.getLogger("Reload").error(f"Could not reload: {e}")
+        else:
+            if changed:
+                asyncio.create_task(recycle_conversations(None, changed))
+    WATCHED.clear()
+    WATCHED.update(watched_files())
+
+
+async def recycle_conversation(
+    update: Update, chat: Tuple[int, int], conv_id: str
+) -> None:
+    if CONV["current"][chat] == conv_id:
+        await create_conversation(update, chat)
+    while RUN[chat].get(conv_id):
+        await asyncio.sleep(RELOAD_DRAIN)
+    conv = CONV["all"][chat].pop(conv_id, None)
+    CONV["cookie"].pop(conv_id, None)
+    RUN[chat].pop(conv_id, None)
+    if CONV["current"][chat] == conv_id:
+        CONV["current"][chat] = ""
+    if conv is not None:
+        await conv[0].close()
+
+
+async def recycle_conversations(update: Update, cookies: List[str]) -> int:
+    bound = [
+        (chat, conv_id)
+        for chat, convs in CONV["all"].items()
+        for conv_id in convs
+        if CONV["cookie"].get(conv_id) in cookies
+    ]
+    results = await asyncio.gather(
+        *(
+            recycle_conversation(update, chat, conv_id)
+            for chat, conv_id in bound
+        ),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.getLogger("Reload").error(result)
+    return len(bound)
+
+
 async def is_active_conversation(
     update: Update,
     new: bool = False,
     finished: bool = False,
     quiet: bool = False,
 ) -> bool:
-    _cid = cid(update)
-    init_chat(_cid)
-    if new or finished or not CONV["current"][_cid]:
+    chat = conv_key(update)
+    init_chat(chat)
+    if new or finished or not CONV["current"][chat]:
         if finished:
-            await CONV["all"][_cid][CONV["current"][_cid]][0].close()
-            del CONV["all"][_cid][CONV["current"][_cid]]
+            await CONV["all"][chat][CONV["current"][chat]][0].close()
+            del CONV["all"][chat][CONV["current"][chat]]
+            CONV["cookie"].pop(CONV["current"][chat], None)
         status = await create_conversation(update)
         if not status:
             return False
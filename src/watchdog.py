@@ -0,0 +1,63 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+
+LAG_INTERVAL = 0.25
+WATCHDOG = {"task": None, "thread": None, "stop": None, "beat": 0.0}
+
+
+async def monitor() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        WATCHDOG["beat"] = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        metrics.LOOP_LAG.observe(max(0, loop.time() - start - LAG_INTERVAL))
+
+
+def heartbeat(ident: int, threshold: float, stop: threading.Event) -> None:
+    reported = 0.0
+    while not stop.wait(threshold / 2):
+        beat = WATCHDOG["beat"]
+        blocked = time.monotonic() - beat - LAG_INTERVAL
+        if blocked > threshold and beat != reported:
+            reported = beat
+            metrics.LOOP_BLOCKED.inc()
+            frame = sys._current_frames().get(ident)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            logging.getLogger("Watchdog").warning(
+                f"Event loop blocked for more than {blocked:.2f}s:\n{stack}"
+            )
+
+
+def start(threshold: float) -> None:
+    if WATCHDOG["task"] is None and threshold > 0:
+        WATCHDOG["beat"] = time.monotonic()
+        WATCHDOG["task"] = asyncio.ensure_future(monitor())
+        WATCHDOG["stop"] = threading.Event()
+        WATCHDOG["thread"] = threading.Thread(
+            target=heartbeat,
+            args=(threading.get_ident(), threshold, WATCHDOG["stop"]),
+            name="watchdog",
+            daemon=True,
+        )
+        WATCHDOG["thread"].start()
+
+
+def stop() -> None:
+    if WATCHDOG["task"] is not None:
+        WATCHDOG["task"].cancel()
+        WATCHDOG["stop"].set()
+        WATCHDOG["thread"].join()
+        WATCHDOG.update(task=None, thread=None, stop=None)
@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: MIT
+
+# Copyright (c) 2023 scmanjarrez. All rights reserved.
+# This work is licensed under the terms of the MIT license.
+
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1].joinpath("src")))
+
+import recorder  # noqa: E402
+
+
+def test_scrub_user_lists() -> None:
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 2,
+            "chat": {"id": -100123, "type": "group", "title": "Family"},
+            "from": {"id": 7, "first_name": "Alice"},
+            "new_chat_members": [
+                {"id": 42, "first_name": "Bob", "username": "bob"},
+                {"id": 43, "first_name": "Carol"},
+            ],
+            "left_chat_member": {"id": 44, "first_name": "Dave"},
+        },
+    }
+    clean = recorder.scrub(update)
+    members = clean["message"]["new_chat_members"]
+    assert [member["id"] for member in members] == [
+        recorder.pseudonym(42),
+        recorder.pseudonym(43),
+    ]
+    assert clean["message"]["left_chat_member"]["id"] == recorder.pseudonym(44)
+    assert clean["message"]["chat"]["id"] < 0
+    for raw in ("Bob", "bob", "Carol", "Dave", "Family"):
+        assert raw not in json.dumps(clean)
+
+
+def test_scrub_file_names() -> None:
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 2,
+            "chat": {"id": 7, "type": "private"},
+            "document": {
+                "file_id": "doc",
+                "file_unique_id": "udoc",
+                "file_name": "alice_passport.pdf",
+                "mime_type": "application/pdf",
+            },
+            "audio": {
+                "file_id": "aud",
+                "file_unique_id": "uaud",
+                "duration": 3,
+                "file_name": "alice_voice.mp3",
+                "performer": "Alice",
+                "title": "Diary",
+            },
+        },
+    }
+    clean = recorder.scrub(update)
+    assert clean["message"]["document"]["mime_type"] == "application/pdf"
+    assert clean["message"]["audio"]["duration"] == 3
+    for raw in ("alice", "Alice", "Diary", "udoc", "uaud"):
+        assert raw not in json.dumps(clean)